@@ -3,7 +3,8 @@
 # See LICENSE file for licensing details.
 
 export UNICORN_BIND_ALL=0.0.0.0
-export UNICORN_SIDEKIQS=1
+# Set by the charm to 0 on the web units, which leave the jobs to standalone sidekiqs
+export UNICORN_SIDEKIQS="${UNICORN_SIDEKIQS:-1}"
 
 cd "$CONTAINER_APP_ROOT/app" || exit
 exec bin/unicorn -c config/unicorn.conf.rb
@@ -0,0 +1,38 @@
+#!/usr/bin/env ruby
+# frozen_string_literal: true
+
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+# Client for the ops runner, see ops_runner.rb.
+#
+# Usage: ops_client.rb SOCKET_PATH < request.json
+#
+# The command output is written to stdout and stderr as it is received, and the client
+# exits with the exit code of the command. It exits with 75 (EX_TEMPFAIL) without running
+# anything if the ops runner is not available, so the caller can run the command itself.
+
+require "json"
+require "socket"
+
+UNAVAILABLE_EXIT_CODE = 75
+
+begin
+  socket = UNIXSocket.new(ARGV.fetch(0))
+rescue SystemCallError => e
+  warn "Ops runner unavailable: #{e.message}"
+  exit UNAVAILABLE_EXIT_CODE
+end
+
+$stdout.sync = true
+$stderr.sync = true
+socket.puts(JSON.parse($stdin.read).to_json)
+
+socket.each_line do |line|
+  message = JSON.parse(line)
+  exit message["exit_code"] if message.key?("exit_code")
+  (message["stream"] == "stderr" ? $stderr : $stdout).write(message["data"])
+end
+
+warn "Ops runner closed the connection before the command completed"
+exit 1
@@ -0,0 +1,170 @@
+#!/usr/bin/env ruby
+# frozen_string_literal: true
+
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+# Long-lived process preloading the Discourse application to run the charm operations.
+#
+# Requests are received over a Unix socket, one JSON line per connection, each served in
+# its own thread:
+#   {"command": "rake" | "runner", "args": [...], "stdin": "..."}
+# Each request runs in a process forked from the preloaded application, so rake tasks
+# calling `exit` and reading from stdin behave as they do from the command line.
+# The output is streamed back as JSON lines, followed by the exit code:
+#   {"stream": "stdout" | "stderr", "data": "..."}
+#   {"exit_code": 0}
+
+require "fileutils"
+require "json"
+require "set"
+require "socket"
+
+APP_PATH = File.join(ENV.fetch("CONTAINER_APP_ROOT", "/srv/discourse"), "app")
+SOCKET_PATH = ENV.fetch("OPS_RUNNER_SOCKET", File.join(APP_PATH, "tmp/sockets/ops-runner.sock"))
+SERVER_PID = Process.pid
+
+Dir.chdir(APP_PATH)
+require File.join(APP_PATH, "config/environment")
+require "rake"
+
+Rails.application.load_tasks
+Discourse.preload_rails! if Discourse.respond_to?(:preload_rails!)
+# Connections are re-established by each forked process.
+ActiveRecord::Base.connection_handler.clear_all_connections!
+Discourse.redis.close
+
+def run_command(request)
+  case request["command"]
+  when "rake"
+    request["args"].each do |task_string|
+      name, args = Rake.application.parse_task_string(task_string)
+      Rake::Task[name].invoke(*args)
+    end
+  when "runner"
+    request["args"].each { |code| eval(code, TOPLEVEL_BINDING) } # rubocop:disable Security/Eval
+  else
+    warn "Unknown command: #{request["command"]}"
+    exit 1
+  end
+end
+
+# Parent side of the pipes and sockets of the requests being served. Forks happen from the
+# threads serving the requests, so each command closes the ones of the other requests,
+# otherwise their pipes would stay open, and their commands never see EOF, until it exits.
+OPEN_IOS = Set.new
+FORK_LOCK = Mutex.new
+
+def send_message(client, message)
+  client.puts(message.to_json)
+  true
+rescue Errno::EPIPE, IOError
+  false
+end
+
+def stop_command(pid)
+  # The command runs in its own process group, including anything it spawned
+  Process.kill("TERM", -pid)
+rescue Errno::ESRCH
+  nil
+end
+
+def spawn_command(server, client, request)
+  FORK_LOCK.synchronize do
+    stdin_reader, stdin_writer = IO.pipe
+    stdout_reader, stdout_writer = IO.pipe
+    stderr_reader, stderr_writer = IO.pipe
+    pid =
+      fork do
+        [server, *OPEN_IOS, client, stdin_writer, stdout_reader, stderr_reader].each(&:close)
+        Process.setpgid(0, 0)
+        $stdin.reopen(stdin_reader)
+        $stdout.reopen(stdout_writer)
+        $stderr.reopen(stderr_writer)
+        $stdout.sync = true
+        $stderr.sync = true
+        Discourse.after_fork
+        run_command(request)
+        exit 0
+      end
+    begin
+      # Also set from the parent so that the command can be stopped right after the fork
+      Process.setpgid(pid, 0)
+    rescue Errno::EACCES, Errno::ESRCH
+      nil
+    end
+    [stdin_reader, stdout_writer, stderr_writer].each(&:close)
+    OPEN_IOS.merge([client, stdin_writer, stdout_reader, stderr_reader])
+    [pid, stdin_writer, stdout_reader, stderr_reader]
+  end
+end
+
+def handle(server, client)
+  request = JSON.parse(client.gets.to_s)
+  pid, stdin_writer, stdout_reader, stderr_reader = spawn_command(server, client, request)
+
+  stdin_thread =
+    Thread.new do
+      stdin_writer.write(request["stdin"].to_s)
+    rescue Errno::EPIPE
+      nil
+    ensure
+      stdin_writer.close
+    end
+
+  # The client sends nothing after the request, so it becoming readable means it went
+  # away, for instance on the timeout of the charm. The command is then stopped rather
+  # than left running unattended.
+  client_connected = true
+  stopped = false
+  streams = { stdout_reader => "stdout", stderr_reader => "stderr" }
+  until streams.empty?
+    watched = client_connected ? [*streams.keys, client] : streams.keys
+    IO.select(watched).first.each do |stream|
+      if stream == client
+        next if client.read_nonblock(1, exception: false) == :wait_readable
+        client_connected = false
+      else
+        data = stream.read_nonblock(65_536, exception: false)
+        next if data == :wait_readable
+        if data.nil?
+          streams.delete(stream)
+          stream.close
+          next
+        end
+        next if !client_connected
+        client_connected =
+          send_message(client, stream: streams[stream], data: data.force_encoding(Encoding::UTF_8).scrub)
+      end
+      next if client_connected || stopped
+      stop_command(pid)
+      stopped = true
+    end
+  end
+
+  stdin_thread.join
+  _, status = Process.wait2(pid)
+  send_message(client, exit_code: status.exitstatus || 128 + status.termsig.to_i) if client_connected
+ensure
+  FORK_LOCK.synchronize { OPEN_IOS.subtract([client, stdin_writer, stdout_reader, stderr_reader]) }
+end
+
+FileUtils.mkdir_p(File.dirname(SOCKET_PATH))
+FileUtils.rm_f(SOCKET_PATH)
+server = UNIXServer.new(SOCKET_PATH)
+File.chmod(0o600, SOCKET_PATH)
+at_exit { FileUtils.rm_f(SOCKET_PATH) if Process.pid == SERVER_PID }
+$stdout.sync = true
+puts "Ops runner listening on #{SOCKET_PATH}"
+
+# Each request is served in its own thread, so a long command doesn't hold the others
+loop do
+  client = server.accept
+  Thread.new(client) do |connection|
+    handle(server, connection)
+  rescue StandardError => e
+    warn "Ops runner request failed: #{e.class}: #{e.message}"
+  ensure
+    connection.close
+  end
+end
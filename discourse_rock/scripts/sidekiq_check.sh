@@ -0,0 +1,26 @@
+#!/bin/bash
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+# Health check of the standalone sidekiq: succeeds if a sidekiq process of this host
+# sent its heartbeat to redis within the last minute.
+
+MAX_HEARTBEAT_AGE=60
+
+redis() {
+    redis-cli -h "$DISCOURSE_REDIS_HOST" -p "$DISCOURSE_REDIS_PORT" --raw "$@"
+}
+
+now=$(date +%s)
+host=$(hostname)
+# Discourse stores the sidekiq keys in the "sidekiq" namespace
+for identity in $(redis smembers sidekiq:processes); do
+    [[ "$identity" == "$host:"* ]] || continue
+    beat=$(redis hget "sidekiq:$identity" beat)
+    if [ -n "$beat" ] && [ $((now - ${beat%.*})) -lt $MAX_HEARTBEAT_AGE ]; then
+        exit 0
+    fi
+done
+
+echo "No sidekiq heartbeat from $host in the last $MAX_HEARTBEAT_AGE seconds" >&2
+exit 1
@@ -0,0 +1,79 @@
+#!/bin/bash
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+# Standalone sidekiq, for the units processing the background jobs only.
+# SIDEKIQ_PROCESSES processes are started, each with DISCOURSE_SIDEKIQ_WORKERS threads
+# and the "queue,weight" pairs of SIDEKIQ_QUEUES, all set by the charm.
+# Like the unicorn master does for the embedded sidekiq, a process using more than
+# UNICORN_SIDEKIQ_MAX_RSS megabytes is gracefully stopped and started again.
+
+RSS_CHECK_INTERVAL=60
+
+cd "$CONTAINER_APP_ROOT/app" || exit
+
+args=(--concurrency "${DISCOURSE_SIDEKIQ_WORKERS:-5}")
+for queue in ${SIDEKIQ_QUEUES:-critical,8 default,4 low,2 ultra_low,1}; do
+    args+=(--queue "$queue")
+done
+max_rss_kb=$((${UNICORN_SIDEKIQ_MAX_RSS:-0} * 1024))
+
+# Prints the resident memory of a process, in kilobytes.
+rss_of() {
+    local key value _
+    while read -r key value _; do
+        if [ "$key" = "VmRSS:" ]; then
+            echo "$value"
+            return
+        fi
+    done <"/proc/$1/status"
+    echo 0
+}
+
+# Runs a sidekiq process, restarting it when it exceeds the memory limit. Returns the
+# exit status of sidekiq once it exits on its own.
+run_sidekiq() {
+    local pid sleeper rss
+    trap 'kill -TERM "$pid" "$sleeper" 2>/dev/null; wait "$pid"; exit' TERM
+    while true; do
+        # bundle exec replaces itself with sidekiq, keeping the pid
+        bin/bundle exec sidekiq "${args[@]}" &
+        pid=$!
+        while true; do
+            sleep "$RSS_CHECK_INTERVAL" &
+            sleeper=$!
+            wait -n "$pid" "$sleeper"
+            kill -0 "$pid" 2>/dev/null || break
+            rss=$(rss_of "$pid" 2>/dev/null)
+            if [ "$max_rss_kb" -gt 0 ] && [ "${rss:-0}" -gt "$max_rss_kb" ]; then
+                echo "Sidekiq $pid uses $((rss / 1024)) MB, more than" \
+                    "$UNICORN_SIDEKIQ_MAX_RSS MB, restarting it" >&2
+                kill -TERM "$pid"
+                wait "$pid"
+                continue 2
+            fi
+        done
+        kill "$sleeper" 2>/dev/null
+        wait "$pid"
+        return
+    done
+}
+
+processes="${SIDEKIQ_PROCESSES:-1}"
+if [ "$processes" -le 1 ]; then
+    run_sidekiq
+    exit
+fi
+
+# Pebble signals the whole process group on stop. If a process exits, the others are
+# stopped too so that pebble restarts the service as a whole.
+trap 'true' TERM
+for _ in $(seq "$processes"); do
+    run_sidekiq &
+done
+wait -n
+status=$?
+# shellcheck disable=SC2046
+kill $(jobs -p) 2>/dev/null
+wait
+exit "$status"
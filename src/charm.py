@@ -5,11 +5,17 @@
 """Charm for Discourse on kubernetes."""
 
 import base64
+import csv
+import dataclasses
+import functools
 import hashlib
+import json
 import logging
 import os.path
+import re
 import secrets
 import string
+import types
 import typing
 from collections import namedtuple
 
@@ -17,6 +23,7 @@ import ops
 from charms.data_platform_libs.v0.data_interfaces import (
     DatabaseCreatedEvent,
     DatabaseEndpointsChangedEvent,
+    DatabaseReadOnlyEndpointsChangedEvent,
 )
 from charms.grafana_k8s.v0.grafana_dashboard import GrafanaDashboardProvider
 from charms.loki_k8s.v0.loki_push_api import LogProxyConsumer
@@ -35,37 +42,320 @@ from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus, WaitingSta
 from ops.pebble import ExecError, ExecProcess, Plan
 
 from constants import (
+    ALLOCATORS,
     CONTAINER_APP_USERNAME,
     CONTAINER_NAME,
     DATABASE_RELATION_NAME,
+    DB_POOLER_MODES,
     DISCOURSE_PATH,
+    FIXTURES_DIGEST_KEY,
+    JEMALLOC_LIBRARY,
     LOG_PATHS,
     MAX_CATEGORY_NESTING_LEVELS,
+    MESSAGE_BUS_REDIS_RELATION_NAME,
+    MIGRATIONS_MANIFEST_FILE,
     OAUTH_RELATION_NAME,
+    OPS_RUNNER_SERVICE_NAME,
+    OPS_RUNNER_SOCKET_PATH,
+    OPS_RUNNER_UNAVAILABLE_EXIT_CODE,
+    PEER_RELATION_NAME,
+    PERFORMANCE_PROFILES,
     PROMETHEUS_PORT,
     REQUIRED_S3_SETTINGS,
+    ROLE_SERVICES,
+    RUBY_GC_PROFILES,
+    RUBY_GC_VARIABLES,
+    SCHEMA_VERSION_KEY,
     SCRIPT_PATH,
     SERVICE_NAME,
     SERVICE_PORT,
     SETUP_COMPLETED_FLAG_FILE,
+    SIDEKIQ_QUEUE_WEIGHTS,
+    SIDEKIQ_SERVICE_NAME,
+    SITE_SETTINGS_DIGEST_FILE,
     THROTTLE_LEVELS,
+    WEB_WORKER_METRICS_PATH,
+    WORKLOAD_VERSION_FILE,
 )
 from database import DatabaseHandler
 from oauth_observer import OAuthObserver
+from resources import (
+    UNICORN_WORKER_MEMORY,
+    compute_db_pool,
+    compute_unicorn_memory,
+    compute_unicorn_workers,
+    get_resource_limits,
+)
 
 logger = logging.getLogger(__name__)
 
 S3Info = namedtuple("S3Info", ["enabled", "region", "bucket", "endpoint"])
+Snapshot = namedtuple("Snapshot", ["digest", "value"])
+
+PROXY_ENVIRONMENT_VARIABLES = (
+    "JUJU_CHARM_HTTP_PROXY",
+    "JUJU_CHARM_HTTPS_PROXY",
+    "JUJU_CHARM_NO_PROXY",
+)
+
+DISCOURSE_COMMANDS = {
+    "rake": [os.path.join(DISCOURSE_PATH, "bin/bundle"), "exec", "rake"],
+    "runner": [os.path.join(DISCOURSE_PATH, "bin/rails"), "runner"],
+}
 
 INVALID_CORS_MESSAGE = (
     "invalid CORS config, `augment_cors_origin` must be enabled or `cors_origin` must be non-empty"  # pylint: disable=line-too-long
 )
 
 
+USER_LIST_FLAGS = ("admin", "active")
+USER_LIST_FLAG_VALUES = {
+    "true": True,
+    "yes": True,
+    "1": True,
+    "false": False,
+    "no": False,
+    "0": False,
+}
+
+
+def _parse_user_csv(users: str) -> typing.List[typing.Dict[str, typing.Any]]:
+    """Parse CSV lines of email[,admin[,active]], with an optional header.
+
+    Args:
+        users: List of users, as CSV.
+
+    Returns:
+        List of users, with the email key and the admin and active keys when present.
+
+    Raises:
+        ValueError: if a line is invalid.
+    """
+    rows = [row for row in csv.reader(users.splitlines()) if row and row[0].strip()]
+    if rows and rows[0][0].strip().lower() == "email":
+        rows = rows[1:]
+    entries = []
+    for row in rows:
+        values = [value.strip().lower() for value in row[1:]]
+        if len(values) > len(USER_LIST_FLAGS) or any(
+            value not in USER_LIST_FLAG_VALUES for value in values
+        ):
+            raise ValueError(f"Invalid user line: {','.join(row)}")
+        entry: typing.Dict[str, typing.Any] = {"email": row[0].strip()}
+        for index, value in enumerate(values):
+            entry[USER_LIST_FLAGS[index]] = USER_LIST_FLAG_VALUES[value]
+        entries.append(entry)
+    return entries
+
+
+def _parse_user_list(users: str) -> typing.List[typing.Dict[str, typing.Any]]:
+    """Parse the list of users to create given to the create-users action.
+
+    The list is either a JSON array of emails or of objects with the email and the boolean
+    admin and active keys, or CSV lines of email[,admin[,active]]. The users are active by
+    default.
+
+    Args:
+        users: List of users, as JSON or CSV.
+
+    Returns:
+        List of users, with the email, admin and active keys, without duplicate emails.
+
+    Raises:
+        ValueError: if the list is invalid.
+    """
+    try:
+        entries = json.loads(users)
+    except json.JSONDecodeError:
+        entries = _parse_user_csv(users)
+    if not isinstance(entries, list):
+        raise ValueError("The users must be a list")
+    parsed: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+    for entry in entries:
+        if isinstance(entry, str):
+            entry = {"email": entry}
+        if not isinstance(entry, dict) or not isinstance(entry.get("email"), str):
+            raise ValueError(f"Invalid user: {entry}")
+        admin, active = entry.get("admin", False), entry.get("active", True)
+        if not isinstance(admin, bool) or not isinstance(active, bool):
+            raise ValueError(f"Invalid user: {entry}")
+        parsed[entry["email"]] = {"email": entry["email"], "admin": admin, "active": active}
+    return list(parsed.values())
+
+
+def _parse_identifier_list(identifiers: str) -> typing.List[str]:
+    """Parse a list of usernames or emails given to the bulk user actions.
+
+    Args:
+        identifiers: Either a JSON array, or values separated by commas or whitespace.
+
+    Returns:
+        List of the identifiers, without duplicates.
+
+    Raises:
+        ValueError: if the list is invalid.
+    """
+    try:
+        values = json.loads(identifiers)
+    except json.JSONDecodeError:
+        values = identifiers.replace(",", " ").split()
+    if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+        raise ValueError("The users must be a list of strings")
+    return list(dict.fromkeys(value.strip() for value in values if value.strip()))
+
+
+def _parse_gc_overrides(gc_overrides: str) -> typing.Dict[str, str]:
+    """Parse the Ruby garbage collector overrides configuration.
+
+    Args:
+        gc_overrides: Comma-separated NAME=value pairs of Ruby GC environment variables.
+
+    Returns:
+        Map of the environment variables to their value.
+
+    Raises:
+        ValueError: if a variable or value is invalid.
+    """
+    overrides = {}
+    for pair in gc_overrides.split(","):
+        if not pair.strip():
+            continue
+        name, _, value = pair.partition("=")
+        name, value = name.strip(), value.strip()
+        if name not in RUBY_GC_VARIABLES:
+            raise ValueError(f"Invalid Ruby GC variable: {name}")
+        try:
+            float(value)
+        except ValueError as exc:
+            raise ValueError(f"Invalid value for {name}: {value}") from exc
+        overrides[name] = value
+    return overrides
+
+
+def _parse_queue_weights(queue_weights: str) -> typing.Dict[str, int]:
+    """Parse the sidekiq queue weights configuration.
+
+    Args:
+        queue_weights: Comma-separated queue:weight pairs, for every sidekiq queue.
+
+    Returns:
+        Map of the queue names to their weight, by decreasing priority.
+
+    Raises:
+        ValueError: if a queue or weight is invalid, or a queue is missing.
+    """
+    weights = {}
+    for pair in queue_weights.split(","):
+        queue, _, weight = pair.strip().partition(":")
+        queue, weight = queue.strip(), weight.strip()
+        if queue not in SIDEKIQ_QUEUE_WEIGHTS or queue in weights:
+            raise ValueError(f"Invalid sidekiq queue: {queue}")
+        if not weight.isdigit() or int(weight) == 0:
+            raise ValueError(f"Invalid weight for sidekiq queue {queue}: {weight}")
+        weights[queue] = int(weight)
+    if weights.keys() != SIDEKIQ_QUEUE_WEIGHTS.keys():
+        raise ValueError("Missing sidekiq queues")
+    return {queue: weights[queue] for queue in SIDEKIQ_QUEUE_WEIGHTS}
+
+
+def _is_planned_as(
+    planned: typing.Optional[typing.Union[ops.pebble.Service, ops.pebble.Check]],
+    layered: typing.Mapping[str, typing.Any],
+) -> bool:
+    """Check if a service or check of the plan has the fields the layer sets.
+
+    Pebble fills the defaults of the fields a layer leaves unset into the plan, such as
+    the threshold of the checks, so only the fields set by the layer are compared.
+
+    Args:
+        planned: The service or check of the plan, None if not planned.
+        layered: The service or check of the layer.
+
+    Returns:
+        True if the planned service or check has all the fields set by the layer.
+    """
+    if planned is None:
+        return False
+    planned_fields = planned.to_dict()
+    return all(
+        planned_fields.get(field) == value
+        for field, value in layered.items()
+        if field != "override"
+    )
+
+
 class MissingRedisRelationDataError(Exception):
     """Custom exception to be raised in case of malformed/missing redis relation data."""
 
 
+@dataclasses.dataclass(frozen=True)
+class RelationState:
+    """Data of the charm relations, parsed once per hook.
+
+    The SAML and OIDC settings are only parsed on first access, as they can only
+    be relied upon once the charm config has been validated.
+
+    Attributes:
+        database: Database settings, as returned by DatabaseHandler.get_relation_data.
+        redis_joined: Whether a redis unit has joined the relation.
+        redis: Hostname and port of the related redis, None if missing or malformed.
+        message_bus_redis_joined: Whether a unit of the message bus redis has joined.
+        message_bus_redis: Hostname and port of the message bus redis, None if not related,
+            missing or malformed.
+        saml_loader: Callable returning the SAML environment settings.
+        oidc_loader: Callable returning the OIDC environment settings.
+    """
+
+    database: typing.Dict[str, str]
+    redis_joined: bool
+    redis: typing.Optional[typing.Tuple[str, int]]
+    message_bus_redis_joined: bool
+    message_bus_redis: typing.Optional[typing.Tuple[str, int]]
+    saml_loader: typing.Callable[[], typing.Dict[str, typing.Any]] = dataclasses.field(repr=False)
+    oidc_loader: typing.Callable[[], typing.Dict[str, typing.Any]] = dataclasses.field(repr=False)
+
+    @functools.cached_property
+    def saml(self) -> typing.Dict[str, typing.Any]:
+        """SAML environment settings."""
+        return self.saml_loader()
+
+    @functools.cached_property
+    def oidc(self) -> typing.Dict[str, typing.Any]:
+        """OIDC environment settings."""
+        return self.oidc_loader()
+
+    @property
+    def database_ready(self) -> bool:
+        """Check if the database relation is ready.
+
+        Returns:
+            True if the database connection settings are available.
+        """
+        return self.database["POSTGRES_HOST"] != ""
+
+    @property
+    def redis_ready(self) -> bool:
+        """Check if the redis relation is ready.
+
+        Returns:
+            True if the redis hostname and port are available.
+        """
+        return self.redis is not None and self.redis[0] not in ("", "None") and self.redis[1] != 0
+
+    @property
+    def message_bus_redis_ready(self) -> bool:
+        """Check if the optional message bus redis relation is ready.
+
+        Returns:
+            True if no message bus redis has joined or its hostname and port are available.
+        """
+        return not self.message_bus_redis_joined or (
+            self.message_bus_redis is not None
+            and self.message_bus_redis[0] not in ("", "None")
+            and self.message_bus_redis[1] != 0
+        )
+
+
 class DiscourseCharm(CharmBase):
     """Charm for Discourse on kubernetes."""
 
@@ -78,6 +368,8 @@ class DiscourseCharm(CharmBase):
         """Initialize defaults and event handlers."""
         super().__init__(*args)
 
+        self._relation_state_snapshot: typing.Optional[Snapshot] = None
+        self._environment_snapshot: typing.Optional[Snapshot] = None
         self._database = DatabaseHandler(self, DATABASE_RELATION_NAME)
         self._oauth = OAuthObserver(self, self._setup_and_activate, self._get_external_hostname)
 
@@ -87,6 +379,10 @@ class DiscourseCharm(CharmBase):
         self.framework.observe(
             self._database.database.on.endpoints_changed, self._on_database_endpoints_changed
         )
+        self.framework.observe(
+            self._database.database.on.read_only_endpoints_changed,
+            self._on_database_read_only_endpoints_changed,
+        )
         self.framework.observe(
             self.on[DATABASE_RELATION_NAME].relation_broken,
             self._on_database_relation_broken,
@@ -102,13 +398,24 @@ class DiscourseCharm(CharmBase):
         self.framework.observe(self.on.config_changed, self._on_config_changed)
         self.framework.observe(self.on.promote_user_action, self._on_promote_user_action)
         self.framework.observe(self.on.create_user_action, self._on_create_user_action)
+        self.framework.observe(self.on.create_users_action, self._on_create_users_action)
         self.framework.observe(self.on.anonymize_user_action, self._on_anonymize_user_action)
+        self.framework.observe(self.on.anonymize_users_action, self._on_anonymize_users_action)
+        self.framework.observe(self.on.promote_users_action, self._on_promote_users_action)
 
         self.redis = RedisRequires(self)
+        self._message_bus_redis = RedisRequires(self, MESSAGE_BUS_REDIS_RELATION_NAME)
         self.framework.observe(self.on.redis_relation_updated, self._redis_relation_changed)
 
         self._metrics_endpoint = MetricsEndpointProvider(
-            self, jobs=[{"static_configs": [{"targets": [f"*:{PROMETHEUS_PORT}"]}]}]
+            self,
+            jobs=[
+                {"static_configs": [{"targets": [f"*:{PROMETHEUS_PORT}"]}]},
+                {
+                    "metrics_path": WEB_WORKER_METRICS_PATH,
+                    "static_configs": [{"targets": [f"*:{SERVICE_PORT}"]}],
+                },
+            ],
         )
         self._logging = LogProxyConsumer(
             self, relation_name="logging", log_files=LOG_PATHS, container_name=CONTAINER_NAME
@@ -116,7 +423,10 @@ class DiscourseCharm(CharmBase):
         self._grafana_dashboards = GrafanaDashboardProvider(self)
 
         self.restart_manager = RollingOpsManager(
-            charm=self, relation="restart", callback=self._on_rolling_restart
+            charm=self, relation=PEER_RELATION_NAME, callback=self._on_rolling_restart
+        )
+        self.framework.observe(
+            self.on[PEER_RELATION_NAME].relation_changed, self._on_peer_relation_changed
         )
 
     def _on_start(self, _: ops.StartEvent) -> None:
@@ -162,13 +472,42 @@ class DiscourseCharm(CharmBase):
     def _on_database_endpoints_changed(self, _: DatabaseEndpointsChangedEvent) -> None:
         """Handle endpoints change.
 
+        Once the setup is completed, a change of endpoint, such as a primary switchover,
+        only needs the services to be replanned with the new database host, unless the
+        database behind it has migrations pending.
+
         Args:
             event: Event triggering the endpoints changed handler.
         """
-        self._execute_migrations()
-        if self._are_relations_ready():
+        if self._is_setup_completed():
+            if not self._are_relations_ready():
+                self._configure_pod()
+                return
+            if not self._is_database_reachable():
+                self._configure_pod()
+                database = self._get_relation_state().database
+                self.model.unit.status = WaitingStatus(
+                    "Waiting for database at "
+                    f"{database['POSTGRES_HOST']}:{database['POSTGRES_PORT']}"
+                )
+                return
+            if not self._has_pending_migrations():
+                logger.info("Database endpoints changed, updating the services without migrations")
+                self._configure_pod()
+                return
+        if self._execute_migrations():
             self._activate_charm()
 
+    def _on_database_read_only_endpoints_changed(
+        self, _: DatabaseReadOnlyEndpointsChangedEvent
+    ) -> None:
+        """Handle read-only endpoints change, which needs no migration.
+
+        Args:
+            event: Event triggering the read-only endpoints changed handler.
+        """
+        self._configure_pod()
+
     def _on_database_relation_broken(self, _: RelationBrokenEvent) -> None:
         """Handle broken relation.
 
@@ -190,6 +529,15 @@ class DiscourseCharm(CharmBase):
         """Handle SAML data available."""
         self._configure_pod()
 
+    def _on_peer_relation_changed(self, _: ops.RelationChangedEvent) -> None:
+        """Handle peer relation changed, resuming the setup once the leader migrated.
+
+        Args:
+            event: Event triggering the peer relation changed handler.
+        """
+        if not self.unit.is_leader() and not self._is_setup_completed():
+            self._setup_and_activate()
+
     def _on_rolling_restart(self, _: ops.EventBase) -> None:
         """Handle rolling restart event.
 
@@ -327,10 +675,237 @@ class DiscourseCharm(CharmBase):
                 if not self.config[s3_config]
             )
 
+        errors.extend(self._get_tuning_config_errors())
+
         if errors:
             self.model.unit.status = BlockedStatus(", ".join(errors))
         return not errors
 
+    def _get_tuning_config_errors(self) -> typing.List[str]:
+        """Check the configuration of the Discourse processes and of the Ruby runtime.
+
+        The consistency of the options is only checked once they are all valid.
+
+        Returns:
+            List of the configuration errors.
+        """
+        errors = self._get_worker_config_errors() + self._get_runtime_config_errors()
+        return errors or self._get_performance_config_errors()
+
+    def _get_worker_config_errors(self) -> typing.List[str]:
+        """Check the configuration of the Discourse processes.
+
+        Returns:
+            List of the configuration errors.
+        """
+        errors = []
+        if self.config["role"] not in ROLE_SERVICES:
+            errors.append(f"role must be one of: {', '.join(ROLE_SERVICES)}")
+        unicorn_workers = str(self._get_tuning("unicorn_workers"))
+        if unicorn_workers != "auto" and not (
+            unicorn_workers.isdigit() and int(unicorn_workers) > 0
+        ):
+            errors.append("unicorn_workers must be 'auto' or a positive integer")
+        if int(self._get_tuning("web_worker_max_memory")) < 0:
+            errors.append("web_worker_max_memory must be a positive integer, or 0 to disable it")
+        for option in ("sidekiq_processes", "sidekiq_concurrency"):
+            if int(self._get_tuning(option)) < 1:
+                errors.append(f"{option} must be a positive integer")
+        try:
+            _parse_queue_weights(str(self.config["sidekiq_queue_weights"]))
+        except ValueError:
+            errors.append(
+                "sidekiq_queue_weights must set a positive weight for each of: "
+                f"{', '.join(SIDEKIQ_QUEUE_WEIGHTS)}"
+            )
+        if int(self.config["db_connection_budget"]) < 0:
+            errors.append("db_connection_budget must be a positive integer, or 0 to disable it")
+        if self.config["db_pooler_mode"] not in DB_POOLER_MODES:
+            errors.append(f"db_pooler_mode must be one of: {', '.join(DB_POOLER_MODES)}")
+        direct_host, _, direct_port = str(self.config["db_direct_endpoint"]).rpartition(":")
+        if self.config["db_direct_endpoint"] and not (direct_host and direct_port.isdigit()):
+            errors.append("db_direct_endpoint must be host:port")
+        return errors
+
+    def _get_db_pool(self) -> int:
+        """Get the size of the database connection pool of each Discourse process.
+
+        Returns:
+            Size of the pool.
+        """
+        runs_sidekiq = self._is_sidekiq_embedded() or SIDEKIQ_SERVICE_NAME in (
+            self._get_role_services()
+        )
+        return compute_db_pool(
+            int(self._get_tuning("sidekiq_concurrency")) if runs_sidekiq else None
+        )
+
+    def _get_db_connections(self) -> int:
+        """Get the maximum number of database connections opened by the unit.
+
+        Each Discourse process, the unicorn workers, the sidekiq processes and the ops runner,
+        can open up to the size of the pool.
+
+        Returns:
+            Number of database connections.
+        """
+        role_services = self._get_role_services()
+        processes = 1
+        if SERVICE_NAME in role_services:
+            processes += self._get_unicorn_workers()
+        if self._is_sidekiq_embedded() or SIDEKIQ_SERVICE_NAME in role_services:
+            processes += int(self._get_tuning("sidekiq_processes"))
+        return processes * self._get_db_pool()
+
+    def _get_runtime_config_errors(self) -> typing.List[str]:
+        """Check the configuration of the Ruby runtime.
+
+        Returns:
+            List of the configuration errors.
+        """
+        errors = []
+        if self.config["allocator"] not in ALLOCATORS:
+            errors.append(f"allocator must be one of: {', '.join(ALLOCATORS)}")
+        if int(self.config["malloc_arena_max"]) < 0:
+            errors.append("malloc_arena_max must be a positive integer, or 0 to unset it")
+        if int(self._get_tuning("yjit_exec_mem_size")) < 1:
+            errors.append("yjit_exec_mem_size must be a positive integer")
+        if self._get_tuning("ruby_gc_profile") not in RUBY_GC_PROFILES:
+            errors.append(f"ruby_gc_profile must be one of: {', '.join(RUBY_GC_PROFILES)}")
+        try:
+            _parse_gc_overrides(str(self.config["ruby_gc_overrides"]))
+        except ValueError:
+            errors.append("ruby_gc_overrides must be NAME=number pairs of RUBY_GC_ variables")
+        return errors
+
+    def _get_role_services(self) -> typing.Tuple[str, ...]:
+        """Get the services run by the unit.
+
+        The sidekiq embedded in the unicorn master always uses the Discourse queue weights,
+        so units with all the roles run the standalone sidekiq when they are customized.
+
+        Returns:
+            Names of the services to enable.
+        """
+        role_services = ROLE_SERVICES.get(typing.cast(str, self.config["role"]), ())
+        if self.config["role"] == "all" and not self._is_sidekiq_embedded():
+            return (*role_services, SIDEKIQ_SERVICE_NAME)
+        return role_services
+
+    def _is_sidekiq_embedded(self) -> bool:
+        """Check if sidekiq runs in the unicorn master.
+
+        Returns:
+            True for units with all the roles and the default queue weights.
+        """
+        return (
+            self.config["role"] == "all"
+            and self._get_sidekiq_queue_weights() == SIDEKIQ_QUEUE_WEIGHTS
+        )
+
+    def _get_sidekiq_queue_weights(self) -> typing.Dict[str, int]:
+        """Get the weights of the sidekiq queues.
+
+        Returns:
+            Map of the queue names to their weight, the Discourse ones if the config is invalid.
+        """
+        try:
+            return _parse_queue_weights(str(self.config["sidekiq_queue_weights"]))
+        except ValueError:
+            return SIDEKIQ_QUEUE_WEIGHTS
+
+    def _get_unicorn_workers(self) -> int:
+        """Get the number of unicorn workers.
+
+        In auto mode, the number of workers is computed from the CPU and memory limits of
+        the container.
+
+        Returns:
+            Number of unicorn workers.
+        """
+        unicorn_workers = str(self._get_tuning("unicorn_workers"))
+        if unicorn_workers.isdigit() and int(unicorn_workers) > 0:
+            return int(unicorn_workers)
+        limits = get_resource_limits(self.unit.get_container(CONTAINER_NAME))
+        return compute_unicorn_workers(
+            limits,
+            reserved_memory=self._get_sidekiq_memory(),
+            extra_worker_memory=self._get_yjit_memory(),
+        )
+
+    def _get_sidekiq_memory(self) -> int:
+        """Get the memory reserved for the sidekiq processes sharing the unicorn container.
+
+        Returns:
+            Memory of the sidekiq processes, in megabytes, as each can grow up to its maximum.
+        """
+        if self.config["role"] != "all":
+            return 0
+        return int(self._get_tuning("sidekiq_max_memory")) * int(
+            self._get_tuning("sidekiq_processes")
+        )
+
+    def _get_yjit_memory(self) -> int:
+        """Get the memory used by YJIT in each process.
+
+        Returns:
+            Maximum size of the YJIT code, in megabytes, 0 if YJIT is disabled.
+        """
+        return int(self._get_tuning("yjit_exec_mem_size")) if self._get_tuning("yjit") else 0
+
+    def _get_tuning(self, option: str) -> typing.Any:
+        """Get the value of a tuning option, from the performance profile if left unset.
+
+        Args:
+            option: Name of the configuration option.
+
+        Returns:
+            Value of the option.
+        """
+        value = self.config.get(option)
+        if value is not None:
+            return value
+        profile = PERFORMANCE_PROFILES.get(self.config["performance_profile"], {})
+        return profile.get(option, PERFORMANCE_PROFILES["auto"][option])
+
+    def _get_performance_config_errors(self) -> typing.List[str]:
+        """Check the performance profile and the resources needed by the tuning options.
+
+        Returns:
+            List of the configuration errors.
+        """
+        if self.config["performance_profile"] not in PERFORMANCE_PROFILES:
+            return [f"performance_profile must be one of: {', '.join(PERFORMANCE_PROFILES)}"]
+        errors = []
+        web_worker_max_memory = int(self._get_tuning("web_worker_max_memory"))
+        if 0 < web_worker_max_memory < UNICORN_WORKER_MEMORY + self._get_yjit_memory():
+            errors.append(
+                "web_worker_max_memory must leave room for the expected memory of a web worker "
+                f"of {UNICORN_WORKER_MEMORY + self._get_yjit_memory()} MB"
+            )
+        unicorn_workers = str(self._get_tuning("unicorn_workers"))
+        if SERVICE_NAME in self._get_role_services() and unicorn_workers.isdigit():
+            memory = compute_unicorn_memory(
+                int(unicorn_workers),
+                reserved_memory=self._get_sidekiq_memory(),
+                extra_worker_memory=self._get_yjit_memory(),
+            )
+            limit = get_resource_limits(self.unit.get_container(CONTAINER_NAME)).memory
+            if limit is not None and memory > limit:
+                errors.append(
+                    f"{unicorn_workers} unicorn workers need about {memory} MB, "
+                    f"over the container memory limit of {limit} MB"
+                )
+        if self.config["db_connection_budget"]:
+            units = max(1, self.app.planned_units())
+            connections = self._get_db_connections() * units
+            if connections > int(self.config["db_connection_budget"]):
+                errors.append(
+                    f"{units} units need up to {connections} database connections, "
+                    f"over the db_connection_budget of {self.config['db_connection_budget']}"
+                )
+        return errors
+
     def _get_saml_config(self) -> typing.Dict[str, typing.Any]:
         """Get SAML configuration.
 
@@ -404,19 +979,47 @@ class DiscourseCharm(CharmBase):
 
         return s3_env
 
-    def _get_redis_relation_data(self) -> typing.Tuple[str, int]:
+    def _get_runtime_env(self) -> typing.Dict[str, str]:
+        """Get the environment variables tuning the Ruby runtime and its memory allocator.
+
+        Returns:
+            Dictionary with the runtime environment settings.
+        """
+        runtime_env = {}
+        if self.config["allocator"] == "jemalloc":
+            runtime_env["LD_PRELOAD"] = JEMALLOC_LIBRARY
+            if self.config["jemalloc_conf"]:
+                runtime_env["MALLOC_CONF"] = str(self.config["jemalloc_conf"])
+        elif self.config["malloc_arena_max"]:
+            runtime_env["MALLOC_ARENA_MAX"] = str(self.config["malloc_arena_max"])
+        if self._get_tuning("yjit"):
+            runtime_env["RUBY_YJIT_ENABLE"] = "1"
+            runtime_env["RUBYOPT"] = f"--yjit-exec-mem-size={self._get_yjit_memory()}"
+        # We only get valid GC profiles and overrides here, otherwise it would be caught
+        # by `_is_config_valid()`.
+        runtime_env.update(RUBY_GC_PROFILES.get(self._get_tuning("ruby_gc_profile"), {}))
+        try:
+            runtime_env.update(_parse_gc_overrides(str(self.config["ruby_gc_overrides"])))
+        except ValueError:
+            logger.warning("Ignoring the invalid ruby_gc_overrides")
+        return runtime_env
+
+    def _get_redis_relation_data(self, redis: RedisRequires) -> typing.Tuple[str, int]:
         """Get the hostname and port from the redis relation data.
 
+        Args:
+            redis: Requirer of the redis relation.
+
         Returns:
             Tuple with the hostname and port of the related redis
         Raises:
             MissingRedisRelationDataError if the some of redis relation data is malformed/missing
         """
-        relation = self.model.get_relation(self.redis.relation_name)
+        relation = self.model.get_relation(redis.relation_name)
         if not relation:
             raise MissingRedisRelationDataError("No redis relation data")
         relation_app_data = relation.data[relation.app]
-        relation_unit_data = self.redis.relation_data
+        relation_unit_data = redis.relation_data
 
         try:
             redis_hostname = str(
@@ -435,17 +1038,117 @@ class DiscourseCharm(CharmBase):
         )
         return (redis_hostname, redis_port)
 
+    def _get_valid_redis_relation_data(
+        self, redis: RedisRequires
+    ) -> typing.Optional[typing.Tuple[str, int]]:
+        """Get the hostname and port from the redis relation data, if valid.
+
+        Args:
+            redis: Requirer of the redis relation.
+
+        Returns:
+            Tuple with the hostname and port of the related redis, None if missing or malformed.
+        """
+        try:
+            return self._get_redis_relation_data(redis)
+        except MissingRedisRelationDataError:
+            return None
+
+    def _get_environment_inputs_digest(self) -> str:
+        """Compute a digest of the inputs the environment settings are derived from.
+
+        Config and relation data bags are cached by ops for the whole dispatch, so
+        computing this digest is cheap compared to parsing the relations and fetching
+        the secrets they reference.
+
+        Returns:
+            Hex digest of the charm config, the relevant relation data and proxy settings.
+        """
+        relations_data: typing.Dict[str, typing.Any] = {}
+        for relation_name in (
+            DATABASE_RELATION_NAME,
+            self.redis.relation_name,
+            MESSAGE_BUS_REDIS_RELATION_NAME,
+            DEFAULT_RELATION_NAME,
+            OAUTH_RELATION_NAME,
+        ):
+            for relation in self.model.relations[relation_name]:
+                relations_data[f"{relation_name}:{relation.id}"] = (
+                    dict(relation.data[relation.app]) if relation.app else {}
+                )
+        redis_unit_data = self.redis.relation_data
+        message_bus_redis_unit_data = self._message_bus_redis.relation_data
+        inputs = {
+            "config": dict(self.config),
+            "relations": relations_data,
+            "redis_unit": dict(redis_unit_data) if redis_unit_data else {},
+            "message_bus_redis_unit": (
+                dict(message_bus_redis_unit_data) if message_bus_redis_unit_data else {}
+            ),
+            "proxy": [os.environ.get(variable) for variable in PROXY_ENVIRONMENT_VARIABLES],
+        }
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+    def _get_relation_state(self) -> RelationState:
+        """Get the parsed relation data.
+
+        The relation data is parsed once and reused for the rest of the dispatch, until
+        the config or the relation data it is derived from change.
+
+        Returns:
+            The parsed relation state.
+        """
+        digest = self._get_environment_inputs_digest()
+        if self._relation_state_snapshot is None or self._relation_state_snapshot.digest != digest:
+            message_bus_redis_joined = self._message_bus_redis.relation_data is not None
+            self._relation_state_snapshot = Snapshot(
+                digest,
+                RelationState(
+                    database=self._database.get_relation_data(),
+                    redis_joined=bool(self.redis.relation_data),
+                    redis=self._get_valid_redis_relation_data(self.redis),
+                    message_bus_redis_joined=message_bus_redis_joined,
+                    message_bus_redis=(
+                        self._get_valid_redis_relation_data(self._message_bus_redis)
+                        if message_bus_redis_joined
+                        else None
+                    ),
+                    saml_loader=self._get_saml_config,
+                    oidc_loader=self._oauth.get_oidc_env,
+                ),
+            )
+        return self._relation_state_snapshot.value
+
     def _create_discourse_environment_settings(self) -> typing.Dict[str, str]:
-        """Create a layer config based on our current configuration.
+        """Get the environment settings for the current configuration and relations.
+
+        The settings are computed once and reused for the rest of the dispatch, until
+        the config or the relation data they are derived from change.
 
         Returns:
             Dictionary with all the environment settings.
         """
-        database_relation_data = self._database.get_relation_data()
+        digest = self._get_environment_inputs_digest()
+        if self._environment_snapshot is None or self._environment_snapshot.digest != digest:
+            self._environment_snapshot = Snapshot(
+                digest, types.MappingProxyType(self._build_discourse_environment_settings())
+            )
+        return dict(self._environment_snapshot.value)
+
+    def _build_discourse_environment_settings(self) -> typing.Dict[str, str]:
+        """Create the environment settings based on our current configuration.
+
+        Returns:
+            Dictionary with all the environment settings.
+        """
+        relation_state = self._get_relation_state()
+        database_relation_data = relation_state.database
 
         # The following could fail if the data is malformed.
         # We/don't catch it because we don't want to silently fail in those cases
-        redis_relation_data = self._get_redis_relation_data()
+        if relation_state.redis is None:
+            raise MissingRedisRelationDataError("No valid redis relation data")
+        redis_relation_data = relation_state.redis
 
         pod_config = {
             # Since pebble exec command doesn't copy the container env (envVars set in Dockerfile),
@@ -456,7 +1159,9 @@ class DiscourseCharm(CharmBase):
             "DISCOURSE_CORS_ORIGIN": self._get_cors_origin(),
             "DISCOURSE_DB_HOST": database_relation_data["POSTGRES_HOST"],
             "DISCOURSE_DB_NAME": database_relation_data["POSTGRES_DB"],
+            "DISCOURSE_DB_POOL": str(self._get_db_pool()),
             "DISCOURSE_DB_PASSWORD": database_relation_data["POSTGRES_PASSWORD"],
+            "DISCOURSE_DB_PORT": database_relation_data["POSTGRES_PORT"],
             "DISCOURSE_DB_USERNAME": database_relation_data["POSTGRES_USER"],
             "DISCOURSE_DEVELOPER_EMAILS": self.config["developer_emails"],
             "DISCOURSE_ENABLE_CORS": str(self.config["enable_cors"]).lower(),
@@ -475,16 +1180,47 @@ class DiscourseCharm(CharmBase):
             "DISCOURSE_SMTP_PASSWORD": self.config["smtp_password"],
             "DISCOURSE_SMTP_PORT": str(self.config["smtp_port"]),
             "DISCOURSE_SMTP_USER_NAME": self.config["smtp_username"],
+            "DISCOURSE_SIDEKIQ_WORKERS": str(self._get_tuning("sidekiq_concurrency")),
             "RAILS_ENV": "production",
-            "UNICORN_SIDEKIQ_MAX_RSS": str(self.config["sidekiq_max_memory"]),
+            "SIDEKIQ_PROCESSES": str(self._get_tuning("sidekiq_processes")),
+            "SIDEKIQ_QUEUES": " ".join(
+                f"{queue},{weight}" for queue, weight in self._get_sidekiq_queue_weights().items()
+            ),
+            "UNICORN_SIDEKIQ_MAX_RSS": str(self._get_tuning("sidekiq_max_memory")),
+            "UNICORN_SIDEKIQS": (
+                str(self._get_tuning("sidekiq_processes")) if self._is_sidekiq_embedded() else "0"
+            ),
+            "UNICORN_WORKERS": str(self._get_unicorn_workers()),
+            "UNICORN_WORKER_MAX_RSS": str(self._get_tuning("web_worker_max_memory")),
         }
-        pod_config.update(self._get_saml_config())
+        pod_config.update(relation_state.saml)
         # Add OIDC env vars if oauth relation is established
-        pod_config.update(self._oauth.get_oidc_env())
+        pod_config.update(relation_state.oidc)
+
+        if database_relation_data["POSTGRES_REPLICA_HOST"]:
+            pod_config["DISCOURSE_DB_REPLICA_HOST"] = database_relation_data[
+                "POSTGRES_REPLICA_HOST"
+            ]
+            pod_config["DISCOURSE_DB_REPLICA_PORT"] = database_relation_data[
+                "POSTGRES_REPLICA_PORT"
+            ]
+
+        if relation_state.message_bus_redis_joined and relation_state.message_bus_redis:
+            pod_config["DISCOURSE_MESSAGE_BUS_REDIS_ENABLED"] = "true"
+            pod_config["DISCOURSE_MESSAGE_BUS_REDIS_HOST"] = relation_state.message_bus_redis[0]
+            pod_config["DISCOURSE_MESSAGE_BUS_REDIS_PORT"] = str(
+                relation_state.message_bus_redis[1]
+            )
 
         if self.config.get("s3_enabled"):
             pod_config.update(self._get_s3_env())
 
+        pod_config.update(self._get_runtime_env())
+
+        # We only get valid pooler modes here, otherwise it would be caught
+        # by `_is_config_valid()`.
+        pod_config.update(DB_POOLER_MODES.get(self.config["db_pooler_mode"], {}))
+
         # We only get valid throttle levels here, otherwise it would be caught
         # by `_is_config_valid()`.
         # self.config return an Any type
@@ -510,6 +1246,24 @@ class DiscourseCharm(CharmBase):
             Dictionary with the pebble configuration.
         """
         logger.info("Generating Layer config")
+        environment = self._create_discourse_environment_settings()
+        role_services = self._get_role_services()
+        sidekiq_check = {
+            "exec": {
+                "command": f"{SCRIPT_PATH}/sidekiq_check.sh",
+                "user": CONTAINER_APP_USERNAME,
+                "environment": environment,
+            }
+        }
+        ready_check: typing.Dict[str, typing.Any]
+        if SERVICE_NAME in role_services:
+            ready_check = {"http": {"url": f"http://localhost:{SERVICE_PORT}/srv/status"}}
+        else:
+            ready_check = sidekiq_check
+        # The standalone sidekiq running next to unicorn gets a check of its own
+        runs_sidekiq_beside_unicorn = (
+            SERVICE_NAME in role_services and SIDEKIQ_SERVICE_NAME in role_services
+        )
         layer_config = {
             "summary": "Discourse layer",
             "description": "Discourse layer",
@@ -519,16 +1273,37 @@ class DiscourseCharm(CharmBase):
                     "summary": "Discourse web application",
                     "command": f"{SCRIPT_PATH}/app_launch.sh",
                     "user": CONTAINER_APP_USERNAME,
-                    "startup": "enabled",
-                    "environment": self._create_discourse_environment_settings(),
+                    "startup": "enabled" if SERVICE_NAME in role_services else "disabled",
+                    "environment": environment,
                     "kill-delay": "20s",
-                }
+                },
+                SIDEKIQ_SERVICE_NAME: {
+                    "override": "replace",
+                    "summary": "Discourse background jobs",
+                    "command": f"{SCRIPT_PATH}/sidekiq_launch.sh",
+                    "user": CONTAINER_APP_USERNAME,
+                    "startup": "enabled" if SIDEKIQ_SERVICE_NAME in role_services else "disabled",
+                    "environment": environment,
+                    # Sidekiq waits up to 25 seconds for the running jobs on shutdown
+                    "kill-delay": "30s",
+                },
+                OPS_RUNNER_SERVICE_NAME: {
+                    "override": "replace",
+                    "summary": "Discourse runner for the charm operations",
+                    "command": f"{SCRIPT_PATH}/ops_runner.rb",
+                    "user": CONTAINER_APP_USERNAME,
+                    "startup": "enabled",
+                    "working-dir": DISCOURSE_PATH,
+                    "environment": environment,
+                },
             },
             "checks": {
-                "discourse-ready": {
+                "discourse-ready": {"override": "replace", "level": "ready", **ready_check},
+                "discourse-sidekiq-ready": {
                     "override": "replace",
                     "level": "ready",
-                    "http": {"url": f"http://localhost:{SERVICE_PORT}/srv/status"},
+                    "startup": "enabled" if runs_sidekiq_beside_unicorn else "disabled",
+                    **sidekiq_check,
                 },
             },
         }
@@ -566,38 +1341,108 @@ class DiscourseCharm(CharmBase):
         Returns:
             If the needed relations have been established.
         """
-        if not self._database.is_relation_ready():
+        relation_state = self._get_relation_state()
+        if not relation_state.database_ready:
             self.model.unit.status = WaitingStatus("Waiting for database relation")
             self._stop_service()
             return False
-        if not self.redis.relation_data:
+        if not relation_state.redis_joined:
             self.model.unit.status = WaitingStatus("Waiting for redis relation")
             self._stop_service()
             return False
-        try:
-            if (
-                self._get_redis_relation_data()[0] in ("", "None")
-                or self._get_redis_relation_data()[1] == 0
-            ):
-                self.model.unit.status = WaitingStatus("Waiting for redis relation to initialize")
-                return False
-        except MissingRedisRelationDataError:
+        if not relation_state.redis_ready:
             self.model.unit.status = WaitingStatus("Waiting for redis relation to initialize")
             return False
+        if not relation_state.message_bus_redis_ready:
+            self.model.unit.status = WaitingStatus(
+                f"Waiting for {MESSAGE_BUS_REDIS_RELATION_NAME} relation to initialize"
+            )
+            return False
         return True
 
-    def _execute_migrations(self) -> None:
+    def _get_schema_version(self) -> typing.Optional[str]:
+        """Get the version of the schema shipped in the image, for the related database.
+
+        As for the site settings, the database identity is the relation and the database
+        name, so that a leader migrating another database doesn't release the other units.
+
+        Returns:
+            Digest of the migrations manifest and the database identity, or None if the
+            image has no manifest.
+        """
+        container = self.unit.get_container(CONTAINER_NAME)
+        if not container.exists(MIGRATIONS_MANIFEST_FILE):
+            return None
+        database = self._get_relation_state().database
+        relation = self.model.get_relation(DATABASE_RELATION_NAME)
+        inputs = {
+            "manifest": container.pull(MIGRATIONS_MANIFEST_FILE).read(),
+            "database": [relation.id if relation else None, database["POSTGRES_DB"]],
+        }
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+    def _execute_migrations(self) -> bool:
+        """Execute the database migrations, on the leader unit only.
+
+        The leader publishes the schema version in the peer relation once migrated,
+        which the other units wait for, unless the database already has all the migrations
+        of their image, as during a rolling upgrade. Units run the migrations themselves if
+        the image has no migrations manifest or the peer relation is not there yet.
+
+        Returns:
+            True if the database schema is migrated, False if not ready or still waiting.
+        """
         container = self.unit.get_container(CONTAINER_NAME)
         if not self._are_relations_ready() or not container.can_connect():
             logger.info("Not ready to execute migrations")
-            return
+            return False
+        schema_version = self._get_schema_version()
+        peer_relation = self.model.get_relation(PEER_RELATION_NAME)
+        if schema_version and peer_relation and not self.unit.is_leader():
+            if peer_relation.data[self.app].get(SCHEMA_VERSION_KEY) == schema_version:
+                logger.info("Migrations executed by the leader, skipping migrations")
+                return True
+            if not self._has_pending_migrations():
+                logger.info("Database schema is up to date, skipping migrations")
+                return True
+            self.model.unit.status = WaitingStatus("Waiting for leader to execute migrations")
+            return False
+        if self._has_pending_migrations():
+            self._run_migrations()
+        else:
+            logger.info("Database schema is up to date, skipping migrations")
+        if schema_version and peer_relation and self.unit.is_leader():
+            peer_relation.data[self.app][SCHEMA_VERSION_KEY] = schema_version
+        return True
+
+    def _get_migrations_environment(self) -> typing.Dict[str, str]:
+        """Get the environment settings of the migrations.
+
+        Behind a connection pooler, the migrations connect to the direct database endpoint
+        if configured, with the advisory locks the pooler may not support.
+
+        Returns:
+            Dictionary with the environment settings.
+        """
         env_settings = self._create_discourse_environment_settings()
+        direct_endpoint = str(self.config["db_direct_endpoint"])
+        if direct_endpoint:
+            host, _, port = direct_endpoint.rpartition(":")
+            env_settings["DISCOURSE_DB_HOST"] = host
+            env_settings["DISCOURSE_DB_PORT"] = port
+            env_settings.pop("DISCOURSE_DB_ADVISORY_LOCKS", None)
+        return env_settings
+
+    def _run_migrations(self) -> None:
+        """Run the db:migrate rake task."""
+        container = self.unit.get_container(CONTAINER_NAME)
+        env_settings = self._get_migrations_environment()
         self.model.unit.status = MaintenanceStatus("Executing migrations")
         # The rails migration task is idempotent and concurrent-safe, from
         # https://stackoverflow.com/questions/17815769/are-rake-dbcreate-and-rake-dbmigrate-idempotent
         # and https://github.com/rails/rails/pull/22122
-        # Thus it's safe to run this task on all units to
-        # avoid complications with how juju schedules charm upgrades
+        # Thus it's safe to run this task on several units, as happens with images
+        # without the migrations manifest or before the peer relation is created
         try:
             migration_process: ExecProcess = container.exec(
                 [f"{DISCOURSE_PATH}/bin/bundle", "exec", "rake", "--trace", "db:migrate"],
@@ -609,22 +1454,123 @@ class DiscourseCharm(CharmBase):
         except ExecError as cmd_err:
             logger.exception("Executing migrations failed with code %d.", cmd_err.exit_code)
             raise
+        self._record_seeded_fixtures()
+
+    def _record_seeded_fixtures(self) -> None:
+        """Record the digest of the fixtures seeded by db:migrate in the database.
+
+        SeedFu does not track the fixtures it seeded, so the digest listed in the manifest
+        is kept in the Rails ar_internal_metadata table, for _has_pending_migrations.
+        """
+        container = self.unit.get_container(CONTAINER_NAME)
+        if not container.exists(MIGRATIONS_MANIFEST_FILE):
+            return
+        manifest = container.pull(MIGRATIONS_MANIFEST_FILE).read().split()
+        fixtures = next((line for line in manifest if line.startswith("fixtures:")), None)
+        if not fixtures:
+            return
+        digest = fixtures.removeprefix("fixtures:")
+        if not re.fullmatch("[0-9a-f]{64}", digest):
+            logger.warning("Invalid fixtures digest in the migrations manifest: %s", digest)
+            return
+        query = (
+            "INSERT INTO ar_internal_metadata (key, value, created_at, updated_at) "  # noqa: S608
+            f"VALUES ('{FIXTURES_DIGEST_KEY}', '{digest}', now(), now()) "  # nosec
+            "ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, updated_at = now()"
+        )
+        try:
+            self._run_psql(query, timeout=30)
+        except ExecError as cmd_err:
+            logger.warning("Recording seeded fixtures failed with code %d", cmd_err.exit_code)
+
+    def _has_pending_migrations(self) -> bool:
+        """Check if migrations shipped in the image are not applied to the database.
+
+        The versions listed in the manifest built in the image are compared with the
+        schema_migrations table, and the digest of its fixtures with the one recorded once
+        seeded, queried with psql to avoid booting Rails.
+
+        Returns:
+            False if all the migrations are applied, True otherwise or if it can't be told.
+        """
+        container = self.unit.get_container(CONTAINER_NAME)
+        if not container.exists(MIGRATIONS_MANIFEST_FILE):
+            return True
+        shipped = set(container.pull(MIGRATIONS_MANIFEST_FILE).read().split())
+        try:
+            applied = self._run_psql(
+                "SELECT version FROM schema_migrations UNION ALL "  # noqa: S608
+                "SELECT 'fixtures:' || value FROM ar_internal_metadata "
+                f"WHERE key = '{FIXTURES_DIGEST_KEY}'",  # nosec
+                timeout=30,
+            )
+        except ExecError as cmd_err:
+            logger.warning("Checking pending migrations failed with code %d", cmd_err.exit_code)
+            return True
+        pending = shipped - set(applied.split())
+        logger.info("%d pending migrations", len(pending))
+        return bool(pending)
+
+    def _is_database_reachable(self) -> bool:
+        """Check that the database accepts connections with a trivial query.
+
+        Returns:
+            True if the query succeeded.
+        """
+        try:
+            self._run_psql("SELECT 1", timeout=10)
+            return True
+        except ExecError as cmd_err:
+            logger.warning("Database probe failed with code %d", cmd_err.exit_code)
+            return False
+
+    def _run_psql(self, query: str, timeout: float) -> str:
+        """Run a query on the database with psql, which spares a Rails boot.
+
+        Args:
+            query: SQL query to run.
+            timeout: Timeout of the query, in seconds.
+
+        Returns:
+            Rows returned by the query, unaligned, without headers.
+
+        Raises:
+            ExecError: if psql failed.
+        """
+        container = self.unit.get_container(CONTAINER_NAME)
+        database = self._get_relation_state().database
+        process = container.exec(
+            ["psql", "--no-align", "--tuples-only", "-c", query],
+            environment={
+                "PGHOST": database["POSTGRES_HOST"],
+                "PGPORT": database["POSTGRES_PORT"],
+                "PGDATABASE": database["POSTGRES_DB"],
+                "PGUSER": database["POSTGRES_USER"],
+                "PGPASSWORD": database["POSTGRES_PASSWORD"],
+                "PGCONNECT_TIMEOUT": "5",
+            },
+            user=CONTAINER_APP_USERNAME,
+            timeout=timeout,
+        )
+        rows, _ = process.wait_output()
+        return rows
 
     def _set_workload_version(self) -> None:
+        """Set the workload version.
+
+        The version is read from the file written in the image at build time, and only
+        queried from Discourse for images without it.
+        """
         container = self.unit.get_container(CONTAINER_NAME)
         if not self._are_relations_ready() or not container.can_connect():
             logger.info("Not ready to set workload version")
             return
-        env_settings = self._create_discourse_environment_settings()
+        logger.info("Setting workload version")
+        if container.exists(WORKLOAD_VERSION_FILE):
+            self.unit.set_workload_version(container.pull(WORKLOAD_VERSION_FILE).read().strip())
+            return
         try:
-            logger.info("Setting workload version")
-            get_version_process = container.exec(
-                [f"{DISCOURSE_PATH}/bin/rails", "runner", "puts Discourse::VERSION::STRING"],
-                environment=env_settings,
-                working_dir=DISCOURSE_PATH,
-                user=CONTAINER_APP_USERNAME,
-            )
-            version, _ = get_version_process.wait_output()
+            version, _ = self._run_discourse_command("runner", ["puts Discourse::VERSION::STRING"])
             self.unit.set_workload_version(version)
         except ExecError as cmd_err:
             logger.exception("Setting workload version failed with code %d.", cmd_err.exit_code)
@@ -665,7 +1611,9 @@ class DiscourseCharm(CharmBase):
         )
         try:
             logger.info("Discourse setup: about to execute migrations")
-            self._execute_migrations()
+            if not self._execute_migrations():
+                logger.info("Discourse setup: waiting for migrations")
+                return
             logger.info("Discourse setup: about to mark the discourse setup process as complete")
             self._set_setup_completed()
             logger.info("Discourse setup: about to set workload version")
@@ -711,7 +1659,8 @@ class DiscourseCharm(CharmBase):
             self._run_s3_migration()
 
         self._activate_charm()
-        if container.can_connect():
+        # The site settings need the schema migrated, which non leaders wait for
+        if container.can_connect() and self._is_setup_completed():
             self._config_force_https()
 
     def _activate_charm(self) -> None:
@@ -734,41 +1683,8 @@ class DiscourseCharm(CharmBase):
         Returns:
             True if the user exists, False otherwise.
         """
-        container = self.unit.get_container(CONTAINER_NAME)
-        user_exists = container.exec(
-            [os.path.join(DISCOURSE_PATH, "bin/bundle"), "exec", "rake", f"users:exists[{email}]"],
-            working_dir=DISCOURSE_PATH,
-            user=CONTAINER_APP_USERNAME,
-            environment=self._create_discourse_environment_settings(),
-        )
-        try:
-            user_exists.wait_output()
-            return True
-        except ExecError as ex:
-            if ex.exit_code == 2:
-                return False
-            raise
-
-    def _activate_user(self, email: str) -> bool:
-        """Activate a user with the given email.
-
-        Args:
-            email: Email of the user to activate.
-        """
-        container = self.unit.get_container(CONTAINER_NAME)
-        activate_process = container.exec(
-            [
-                os.path.join(DISCOURSE_PATH, "bin/bundle"),
-                "exec",
-                "rake",
-                f"users:activate[{email}]",
-            ],
-            working_dir=DISCOURSE_PATH,
-            user=CONTAINER_APP_USERNAME,
-            environment=self._create_discourse_environment_settings(),
-        )
         try:
-            activate_process.wait_output()
+            self._run_discourse_command("rake", [f"users:exists[{email}]"])
             return True
         except ExecError as ex:
             if ex.exit_code == 2:
@@ -792,21 +1708,10 @@ class DiscourseCharm(CharmBase):
             event.fail(f"User with email {email} does not exist")
             return
 
-        process = container.exec(
-            [
-                os.path.join(DISCOURSE_PATH, "bin/bundle"),
-                "exec",
-                "rake",
-                "admin:create",
-            ],
-            stdin=f"{email}\nn\nY\n",
-            working_dir=DISCOURSE_PATH,
-            user=CONTAINER_APP_USERNAME,
-            environment=self._create_discourse_environment_settings(),
-            timeout=60,
-        )
         try:
-            process.wait_output()
+            self._run_discourse_command(
+                "rake", ["admin:create"], stdin=f"{email}\nn\nY\n", timeout=60
+            )
             event.set_results({"user": email})
         except ExecError as ex:
             event.fail(
@@ -825,43 +1730,225 @@ class DiscourseCharm(CharmBase):
             return
 
         email = event.params["email"]
-        password = self._generate_password(16)
+        user = {
+            "email": email,
+            "admin": bool(event.params.get("admin")),
+            "active": bool(event.params.get("active")),
+        }
 
-        if self._user_exists(email):
+        try:
+            result = self._create_users([user]).get(email, {"status": "failed", "errors": []})
+        except ExecError as ex:
+            event.fail(f"Failed to make user with email {email}: {ex.stdout}")  # type: ignore
+            return
+
+        if result["status"] == "exists":
             event.fail(f"User with email {email} already exists")
             return
+        if result["status"] != "created":
+            event.fail(f"Failed to make user with email {email}: {', '.join(result['errors'])}")
+            return
+
+        event.set_results({"user": email, "password": result["password"]})
+
+    def _on_create_users_action(self, event: ActionEvent) -> None:
+        """Create users in Discourse in bulk.
+
+        Args:
+            event: Event triggering the create_users action.
+        """
+        container = self.unit.get_container(CONTAINER_NAME)
+        if not container.can_connect():
+            event.fail("Unable to connect to container, container is not ready")
+            return
+
+        try:
+            users = _parse_user_list(event.params["users"])
+        except ValueError as ex:
+            event.fail(str(ex))
+            return
+
+        try:
+            results = self._create_users(users, log=event.log)
+        except ExecError as ex:
+            event.fail(f"Failed to create users: {ex.stdout}")  # type: ignore
+            return
+
+        statuses = [result["status"] for result in results.values()]
+        event.set_results(
+            {
+                "users": json.dumps(results, separators=(",", ":")),
+                "created": statuses.count("created"),
+                "existing": statuses.count("exists"),
+                "failed": len(statuses) - statuses.count("created") - statuses.count("exists"),
+            }
+        )
+
+    def _create_users(
+        self,
+        users: typing.List[typing.Dict[str, typing.Any]],
+        log: typing.Optional[typing.Callable[[str], None]] = None,
+    ) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+        """Create users in a single run of the users:create rake task.
+
+        Args:
+            users: Users to create, with the email, admin and active keys.
+            log: Callback receiving the progress messages.
+
+        Returns:
+            Map of the user emails to their status, with the password of the created users.
+
+        Raises:
+            ExecError: if the rake task failed.
+        """
+        passwords = {user["email"]: self._generate_password(16) for user in users}
+        results = self._run_users_task(
+            "users:create",
+            "email",
+            [user | {"password": passwords[user["email"]]} for user in users],
+            # Creating a user takes well under a second once Rails is booted
+            timeout=60 + len(users),
+            log=log,
+        )
+        for email, result in results.items():
+            if result["status"] == "created":
+                result["password"] = passwords[email]
+        return results
+
+    def _run_users_task(
+        self,
+        task: str,
+        key: str,
+        users: typing.List[typing.Any],
+        *,
+        timeout: typing.Optional[float] = None,
+        log: typing.Optional[typing.Callable[[str], None]] = None,
+    ) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+        """Run a rake task processing a list of users in batches.
+
+        The task reads the users as JSON on stdin, and prints a JSON line with the status of
+        each user, identified by the given key, and the progress after each batch.
+
+        Args:
+            task: Name of the rake task.
+            key: Key identifying the users in the task output.
+            users: Users to process.
+            timeout: Timeout of the task, in seconds.
+            log: Callback receiving the progress messages.
+
+        Returns:
+            Map of the user identifiers to their status, with the errors of the failed users.
 
-        # Admin flag is optional, if it is true, the user will be created as an admin
-        admin_flag = "Y" if event.params.get("admin") else "N"
+        Raises:
+            ExecError: if the rake task failed.
+        """
+        results: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+
+        def handle_output(line: str) -> None:
+            # Skip anything else printed by Discourse, such as deprecation warnings
+            if not line.startswith("{"):
+                return
+            try:
+                message = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning("Skipping unexpected output of the rake task: %s", line)
+                return
+            if "progress" in message:
+                if log:
+                    log(f"Processed {message['progress']['done']}/{message['progress']['total']}")
+                return
+            result = {"status": message["status"]}
+            if "errors" in message:
+                result["errors"] = message["errors"]
+            results[message[key]] = result
+
+        self._run_discourse_command(
+            "rake", [task], stdin=json.dumps(users), timeout=timeout, on_output=handle_output
+        )
+        return results
+
+    def _run_discourse_command(
+        self,
+        command: str,
+        args: typing.List[str],
+        *,
+        stdin: typing.Optional[str] = None,
+        timeout: typing.Optional[float] = None,
+        on_output: typing.Optional[typing.Callable[[str], None]] = None,
+    ) -> typing.Tuple[str, typing.Optional[str]]:
+        """Run a rake task or Rails runner code in the Discourse container.
+
+        The command is sent to the ops runner, which avoids booting Rails, if it is up.
+        Otherwise, it is executed in a new process.
 
+        Args:
+            command: Either "rake" or "runner".
+            args: Arguments of the command.
+            stdin: Input of the command.
+            timeout: Timeout of the command, in seconds.
+            on_output: Callback receiving each line of the standard output as it is produced.
+
+        Returns:
+            Tuple with the standard output and error of the command.
+
+        Raises:
+            ExecError: if the command failed.
+        """
+        container = self.unit.get_container(CONTAINER_NAME)
+        if container.exists(OPS_RUNNER_SOCKET_PATH):
+            request = json.dumps({"command": command, "args": args, "stdin": stdin or ""})
+            process = container.exec(
+                [f"{SCRIPT_PATH}/ops_client.rb", OPS_RUNNER_SOCKET_PATH],
+                stdin=request,
+                working_dir=DISCOURSE_PATH,
+                user=CONTAINER_APP_USERNAME,
+                timeout=timeout,
+            )
+            try:
+                return self._wait_output(process, on_output)
+            except ExecError as ex:
+                if ex.exit_code != OPS_RUNNER_UNAVAILABLE_EXIT_CODE:
+                    raise
+                logger.warning("Ops runner unavailable, running %s %s directly", command, args)
         process = container.exec(
-            [
-                os.path.join(DISCOURSE_PATH, "bin/bundle"),
-                "exec",
-                "rake",
-                "admin:create",
-            ],
-            stdin=f"{email}\n{password}\n{password}\n{admin_flag}\n",
+            [*DISCOURSE_COMMANDS[command], *args],
+            stdin=stdin,
             working_dir=DISCOURSE_PATH,
             user=CONTAINER_APP_USERNAME,
             environment=self._create_discourse_environment_settings(),
-            timeout=60,
+            timeout=timeout,
         )
-        try:
-            process.wait_output()
-        except ExecError as ex:
-            event.fail(f"Failed to make user with email {email}: {ex.stdout}")  # type: ignore
-            return
+        return self._wait_output(process, on_output)
 
-        if (
-            not event.params.get("admin")
-            and event.params.get("active")
-            and not self._activate_user(email)
-        ):
-            event.fail(f"Could not find user {email} to activate")
-            return
+    @staticmethod
+    def _wait_output(
+        process: ExecProcess, on_output: typing.Optional[typing.Callable[[str], None]]
+    ) -> typing.Tuple[str, typing.Optional[str]]:
+        """Wait for a process to finish, streaming its standard output to a callback.
+
+        Args:
+            process: Process to wait for.
+            on_output: Callback receiving each line of the standard output.
 
-        event.set_results({"user": email, "password": password})
+        Returns:
+            Tuple with the standard output and error of the process.
+
+        Raises:
+            ExecError: if the process failed.
+        """
+        if on_output is None:
+            return process.wait_output()
+        lines = []
+        for line in typing.cast(typing.TextIO, process.stdout):
+            lines.append(line)
+            on_output(line)
+        stdout = "".join(lines)
+        stderr = process.stderr.read() if process.stderr else None
+        try:
+            process.wait()
+        except ExecError as ex:
+            raise ExecError(ex.command, ex.exit_code, stdout, stderr) from ex
+        return stdout, typing.cast(typing.Optional[str], stderr)
 
     def _generate_password(self, length: int) -> str:
         """Generate a random password.
@@ -876,21 +1963,40 @@ class DiscourseCharm(CharmBase):
         password = "".join([secrets.choice(choices) for _ in range(length)])
         return password
 
+    def _get_site_settings_digest(self) -> str:
+        """Compute a digest of the inputs of the site settings managed by the charm.
+
+        Site settings are stored in the database, so the database identity is part of them.
+        The identity is the relation and the database name rather than the endpoint, which
+        changes on a switchover of the primary without the stored settings changing.
+
+        Returns:
+            Hex digest of the site settings and the database they are stored in.
+        """
+        database = self._get_relation_state().database
+        relation = self.model.get_relation(DATABASE_RELATION_NAME)
+        inputs = {
+            "force_https": bool(self.config["force_https"]),
+            "database": [relation.id if relation else None, database["POSTGRES_DB"]],
+        }
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
     def _config_force_https(self) -> None:
-        """Config Discourse to force_https option based on charm configuration."""
+        """Config Discourse to force_https option based on charm configuration.
+
+        The Rails runner is skipped if the setting has already been applied to the database.
+        """
         container = self.unit.get_container(CONTAINER_NAME)
+        digest = self._get_site_settings_digest()
+        if (
+            container.exists(SITE_SETTINGS_DIGEST_FILE)
+            and container.pull(SITE_SETTINGS_DIGEST_FILE).read().strip() == digest
+        ):
+            logger.info("Site settings unchanged, skipping force_https configuration")
+            return
         force_bool = str(self.config["force_https"]).lower()
-        process = container.exec(
-            [
-                os.path.join(DISCOURSE_PATH, "bin/rails"),
-                "runner",
-                f"SiteSetting.force_https={force_bool}",
-            ],
-            working_dir=DISCOURSE_PATH,
-            user=CONTAINER_APP_USERNAME,
-            environment=self._create_discourse_environment_settings(),
-        )
-        process.wait_output()
+        self._run_discourse_command("runner", [f"SiteSetting.force_https={force_bool}"])
+        container.push(SITE_SETTINGS_DIGEST_FILE, digest, make_dirs=True)
 
     def _on_anonymize_user_action(self, event: ActionEvent) -> None:
         """Anonymize data from a user.
@@ -904,19 +2010,8 @@ class DiscourseCharm(CharmBase):
             event.fail("Unable to connect to container, container is not ready")
             return
 
-        process = container.exec(
-            [
-                os.path.join(DISCOURSE_PATH, "bin/bundle"),
-                "exec",
-                "rake",
-                f"users:anonymize[{username}]",
-            ],
-            working_dir=DISCOURSE_PATH,
-            user=CONTAINER_APP_USERNAME,
-            environment=self._create_discourse_environment_settings(),
-        )
         try:
-            process.wait_output()
+            self._run_discourse_command("rake", [f"users:anonymize[{username}]"])
             event.set_results({"user": f"{username}"})
         except ExecError as ex:
             event.fail(
@@ -925,25 +2020,166 @@ class DiscourseCharm(CharmBase):
                 f"Failed to anonymize user with username {username}:{ex.stdout}"  # type: ignore
             )
 
+    def _on_anonymize_users_action(self, event: ActionEvent) -> None:
+        """Anonymize data from users in bulk.
+
+        Args:
+            event: Event triggering the anonymize_users action.
+        """
+        self._run_bulk_user_action(
+            event, "users:anonymize_batch", "usernames", "username", "anonymized"
+        )
+
+    def _on_promote_users_action(self, event: ActionEvent) -> None:
+        """Promote users to admin in bulk.
+
+        Args:
+            event: Event triggering the promote_users action.
+        """
+        self._run_bulk_user_action(
+            event, "users:promote_batch", "emails", "email", "promoted", timeout=60
+        )
+
+    def _run_bulk_user_action(  # pylint: disable=too-many-arguments
+        self,
+        event: ActionEvent,
+        task: str,
+        param: str,
+        key: str,
+        done_status: str,
+        timeout: typing.Optional[float] = None,
+    ) -> None:
+        """Run a bulk user action, processing all the users in a single rake task.
+
+        A failure for a user does not abort the others. The results map each user to its
+        status and are summarized by status.
+
+        Args:
+            event: Event triggering the action.
+            task: Name of the rake task processing the users.
+            param: Name of the action parameter with the list of users.
+            key: Key identifying the users in the task output.
+            done_status: Status of the users successfully processed.
+            timeout: Base timeout of the task, in seconds, extended by one second per user.
+        """
+        container = self.unit.get_container(CONTAINER_NAME)
+        if not container.can_connect():
+            event.fail("Unable to connect to container, container is not ready")
+            return
+
+        try:
+            users = _parse_identifier_list(event.params[param])
+        except ValueError as ex:
+            event.fail(str(ex))
+            return
+
+        try:
+            results = self._run_users_task(
+                task,
+                key,
+                users,
+                timeout=timeout + len(users) if timeout else None,
+                log=event.log,
+            )
+        except ExecError as ex:
+            event.fail(f"Failed to process users: {ex.stdout}")  # type: ignore
+            return
+
+        statuses = [result["status"] for result in results.values()]
+        event.set_results(
+            {
+                "users": json.dumps(results, separators=(",", ":")),
+                done_status: statuses.count(done_status),
+                "not-found": statuses.count("not-found"),
+                "failed": statuses.count("failed"),
+            }
+        )
+
+    def _is_layer_active(
+        self, container: ops.Container, layer_config: ops.pebble.LayerDict
+    ) -> bool:
+        """Check if the layer is already planned as is and all its services are running.
+
+        Args:
+            container: The workload container.
+            layer_config: The pebble layer to check.
+
+        Returns:
+            True if applying the layer and replanning would be a no-op.
+        """
+        plan = container.get_plan()
+        services = layer_config.get("services", {})
+        checks = layer_config.get("checks", {})
+        if not all(
+            _is_planned_as(plan.services.get(name), service) for name, service in services.items()
+        ):
+            return False
+        if not all(_is_planned_as(plan.checks.get(name), check) for name, check in checks.items()):
+            return False
+        enabled_services = [
+            name for name, service in services.items() if service.get("startup") == "enabled"
+        ]
+        return all(
+            service.is_running() for service in container.get_services(*enabled_services).values()
+        )
+
     def _start_service(self):
         """Start discourse."""
         logger.info("Starting discourse")
         container = self.unit.get_container(CONTAINER_NAME)
         if self._is_config_valid() and container.can_connect():
             layer_config = self._create_layer_config()
+            if self._is_layer_active(container, layer_config):
+                logger.info("Pebble layer unchanged, skipping replan")
+                return
             container.add_layer(SERVICE_NAME, layer_config, combine=True)
             container.pebble.replan_services()
+            # Replan does not stop the services and checks the unit role no longer runs
+            disabled_services = [
+                name
+                for name, service in layer_config.get("services", {}).items()
+                if service.get("startup") == "disabled"
+            ]
+            running_services = [
+                name
+                for name, service in container.get_services(*disabled_services).items()
+                if disabled_services and service.is_running()
+            ]
+            if running_services:
+                container.stop(*running_services)
+            disabled_checks = [
+                name
+                for name, check in layer_config.get("checks", {}).items()
+                if check.get("startup") == "disabled"
+            ]
+            running_checks = [
+                name
+                for name, check in container.get_checks(*disabled_checks).items()
+                if disabled_checks and check.status != ops.pebble.CheckStatus.INACTIVE
+            ]
+            if running_checks:
+                container.stop_checks(*running_checks)
 
     def _stop_service(self):
         """Stop discourse, this operation is idempotent."""
         logger.info("Stopping discourse")
         container = self.unit.get_container(CONTAINER_NAME)
-        if (
-            container.can_connect()
-            and SERVICE_NAME in container.get_plan().services
-            and container.get_service(SERVICE_NAME).is_running()
-        ):
-            container.stop(CONTAINER_NAME)
+        if not container.can_connect():
+            return
+        planned_services = [
+            name
+            for name in (SERVICE_NAME, SIDEKIQ_SERVICE_NAME, OPS_RUNNER_SERVICE_NAME)
+            if name in container.get_plan().services
+        ]
+        if not planned_services:
+            return
+        running_services = [
+            name
+            for name, service in container.get_services(*planned_services).items()
+            if service.is_running()
+        ]
+        if running_services:
+            container.stop(*running_services)
 
 
 if __name__ == "__main__":  # pragma: no cover
@@ -31,6 +31,105 @@ THROTTLE_LEVELS["strict"] = {
     "DISCOURSE_MAX_ASSET_REQS_PER_IP_PER_10_SECONDS": "200",
     "DISCOURSE_MAX_REQS_RATE_LIMIT_ON_PRIVATE": "false",
 }
+# Ruby garbage collector environment variables read by Ruby 3.3. The initial heap is sized
+# per size pool, RUBY_GC_HEAP_INIT_SLOTS having no effect since Ruby 3.3.
+RUBY_GC_VARIABLES = (
+    *(f"RUBY_GC_HEAP_{size_pool}_INIT_SLOTS" for size_pool in range(5)),
+    "RUBY_GC_HEAP_FREE_SLOTS",
+    "RUBY_GC_HEAP_FREE_SLOTS_MIN_RATIO",
+    "RUBY_GC_HEAP_FREE_SLOTS_GOAL_RATIO",
+    "RUBY_GC_HEAP_FREE_SLOTS_MAX_RATIO",
+    "RUBY_GC_HEAP_GROWTH_FACTOR",
+    "RUBY_GC_HEAP_GROWTH_MAX_SLOTS",
+    "RUBY_GC_HEAP_OLDOBJECT_LIMIT_FACTOR",
+    "RUBY_GC_HEAP_REMEMBERED_WB_UNPROTECTED_OBJECTS_LIMIT_RATIO",
+    "RUBY_GC_MALLOC_LIMIT",
+    "RUBY_GC_MALLOC_LIMIT_MAX",
+    "RUBY_GC_MALLOC_LIMIT_GROWTH_FACTOR",
+    "RUBY_GC_OLDMALLOC_LIMIT",
+    "RUBY_GC_OLDMALLOC_LIMIT_MAX",
+    "RUBY_GC_OLDMALLOC_LIMIT_GROWTH_FACTOR",
+)
+# Ruby garbage collector settings of each GC profile, over the Ruby defaults
+RUBY_GC_PROFILES: typing.Dict = defaultdict(dict)
+RUBY_GC_PROFILES["default"] = {}
+RUBY_GC_PROFILES["throughput"] = {
+    # Slots of 40, 80, 160, 320 and 640 bytes, most objects of Discourse fitting in the
+    # smallest ones
+    "RUBY_GC_HEAP_0_INIT_SLOTS": "600000",
+    "RUBY_GC_HEAP_1_INIT_SLOTS": "300000",
+    "RUBY_GC_HEAP_2_INIT_SLOTS": "100000",
+    "RUBY_GC_HEAP_3_INIT_SLOTS": "30000",
+    "RUBY_GC_HEAP_4_INIT_SLOTS": "10000",
+    "RUBY_GC_HEAP_GROWTH_FACTOR": "1.5",
+    "RUBY_GC_HEAP_OLDOBJECT_LIMIT_FACTOR": "2.0",
+    "RUBY_GC_MALLOC_LIMIT": "64000000",
+    "RUBY_GC_MALLOC_LIMIT_MAX": "128000000",
+    "RUBY_GC_OLDMALLOC_LIMIT": "64000000",
+    "RUBY_GC_OLDMALLOC_LIMIT_MAX": "256000000",
+}
+# The initial heap is left to the Ruby defaults, growing slowly from there
+RUBY_GC_PROFILES["low-memory"] = {
+    "RUBY_GC_HEAP_GROWTH_FACTOR": "1.1",
+    "RUBY_GC_HEAP_GROWTH_MAX_SLOTS": "40000",
+    "RUBY_GC_HEAP_OLDOBJECT_LIMIT_FACTOR": "1.2",
+    "RUBY_GC_MALLOC_LIMIT": "8000000",
+    "RUBY_GC_MALLOC_LIMIT_MAX": "16000000",
+    "RUBY_GC_OLDMALLOC_LIMIT": "8000000",
+    "RUBY_GC_OLDMALLOC_LIMIT_MAX": "32000000",
+}
+# Tuning options of each performance profile, for the options left unset. The auto profile
+# holds the values of the options missing from the other profiles and sizes the unicorn
+# workers from the container limits.
+PERFORMANCE_PROFILES: typing.Dict = defaultdict(dict)
+PERFORMANCE_PROFILES["auto"] = {
+    "unicorn_workers": "auto",
+    "web_worker_max_memory": 0,
+    "sidekiq_processes": 1,
+    "sidekiq_concurrency": 5,
+    "sidekiq_max_memory": 1000,
+    "ruby_gc_profile": "default",
+    "yjit": False,
+    "yjit_exec_mem_size": 48,
+}
+PERFORMANCE_PROFILES["small"] = {
+    "unicorn_workers": "2",
+    "web_worker_max_memory": 600,
+    "sidekiq_processes": 1,
+    "sidekiq_concurrency": 5,
+    "sidekiq_max_memory": 500,
+    "ruby_gc_profile": "low-memory",
+}
+PERFORMANCE_PROFILES["medium"] = {
+    "unicorn_workers": "4",
+    "web_worker_max_memory": 800,
+    "sidekiq_processes": 1,
+    "sidekiq_concurrency": 10,
+    "sidekiq_max_memory": 1000,
+    "ruby_gc_profile": "default",
+    "yjit": True,
+    "yjit_exec_mem_size": 48,
+}
+PERFORMANCE_PROFILES["large"] = {
+    "unicorn_workers": "8",
+    "web_worker_max_memory": 1000,
+    "sidekiq_processes": 2,
+    "sidekiq_concurrency": 15,
+    "sidekiq_max_memory": 1500,
+    "ruby_gc_profile": "throughput",
+    "yjit": True,
+    "yjit_exec_mem_size": 64,
+}
+# Discourse database settings for each mode of the connection pooler in front of PostgreSQL
+DB_POOLER_MODES: typing.Dict = defaultdict(dict)
+DB_POOLER_MODES["none"] = {}
+DB_POOLER_MODES["session"] = {}
+# Transaction pooling doesn't keep the session state the prepared statements and the
+# advisory locks of the migrations rely on
+DB_POOLER_MODES["transaction"] = {
+    "DISCOURSE_DB_PREPARED_STATEMENTS": "false",
+    "DISCOURSE_DB_ADVISORY_LOCKS": "false",
+}
 LOG_PATHS = [
     f"{DISCOURSE_PATH}/log/production.log",
     f"{DISCOURSE_PATH}/log/unicorn.stderr.log",
@@ -38,13 +137,43 @@ LOG_PATHS = [
 ]
 MAX_CATEGORY_NESTING_LEVELS = [2, 3]
 PROMETHEUS_PORT = 3000
+# Metrics of the web worker recycling, served by the Discourse initializer of the rock
+WEB_WORKER_METRICS_PATH = "/srv/charm-metrics"
 REQUIRED_S3_SETTINGS = ["s3_access_key_id", "s3_bucket", "s3_region", "s3_secret_access_key"]
 SCRIPT_PATH = "/srv/scripts"
 SERVICE_NAME = "discourse"
+SIDEKIQ_SERVICE_NAME = "discourse-sidekiq"
+# Services run by each role of the units
+ROLE_SERVICES = {
+    "all": (SERVICE_NAME,),
+    "web": (SERVICE_NAME,),
+    "worker": (SIDEKIQ_SERVICE_NAME,),
+}
+# Sidekiq queues, by decreasing priority, with the weights used by Discourse
+SIDEKIQ_QUEUE_WEIGHTS = {"critical": 8, "default": 4, "low": 2, "ultra_low": 1}
+# Memory allocators of the Ruby processes, and the jemalloc library shipped in the rock
+ALLOCATORS = ("glibc", "jemalloc")
+JEMALLOC_LIBRARY = "/usr/lib/x86_64-linux-gnu/libjemalloc.so.2"
+OPS_RUNNER_SERVICE_NAME = "discourse-ops-runner"
+OPS_RUNNER_SOCKET_PATH = f"{DISCOURSE_PATH}/tmp/sockets/ops-runner.sock"  # noqa: S108
+# Exit code of the ops runner client when the ops runner can't be reached (EX_TEMPFAIL)
+OPS_RUNNER_UNAVAILABLE_EXIT_CODE = 75
 CONTAINER_NAME = "discourse"
 CONTAINER_APP_USERNAME = "_daemon_"
 SERVICE_PORT = 3000
 SETUP_COMPLETED_FLAG_FILE = "/run/discourse-k8s-operator/setup_completed"
+SITE_SETTINGS_DIGEST_FILE = "/run/discourse-k8s-operator/site_settings_digest"
+# Discourse version, written in the rock at build time
+WORKLOAD_VERSION_FILE = "/srv/discourse/version"
+# Versions of the migrations shipped in the rock, and digest of its seed fixtures prefixed
+# with "fixtures:", written at build time
+MIGRATIONS_MANIFEST_FILE = "/srv/discourse/migrations"
+# Key of the ar_internal_metadata row recording the digest of the seeded fixtures
+FIXTURES_DIGEST_KEY = "discourse_charm_fixtures"
 DATABASE_RELATION_NAME = "database"
+MESSAGE_BUS_REDIS_RELATION_NAME = "redis-message-bus"
+PEER_RELATION_NAME = "restart"
+# Peer application data key of the schema version migrated by the leader
+SCHEMA_VERSION_KEY = "schema-version"
 OAUTH_RELATION_NAME = "oauth"
 OAUTH_SCOPE = "openid email"
@@ -44,6 +44,8 @@ class DatabaseHandler(Object):
             "POSTGRES_HOST": "",
             "POSTGRES_PORT": "",
             "POSTGRES_DB": "",
+            "POSTGRES_REPLICA_HOST": "",
+            "POSTGRES_REPLICA_PORT": "",
         }
 
         if self.model.get_relation(self.relation_name) is None:
@@ -60,12 +62,22 @@ class DatabaseHandler(Object):
         if len(primary_endpoint) < 2:
             return default
 
+        # Discourse supports a single replica, the first of the read-only endpoints
+        replica_endpoints = [
+            endpoint.split(":")
+            for endpoint in relation_data.get("read-only-endpoints", "").split(",")
+            if len(endpoint.split(":")) >= 2
+        ]
+        replica_endpoint = replica_endpoints[0] if replica_endpoints else ["", ""]
+
         data = {
             "POSTGRES_USER": relation_data.get("username"),
             "POSTGRES_PASSWORD": relation_data.get("password"),
             "POSTGRES_HOST": primary_endpoint[0],
             "POSTGRES_PORT": primary_endpoint[1],
             "POSTGRES_DB": relation_data.get("database"),
+            "POSTGRES_REPLICA_HOST": replica_endpoint[0],
+            "POSTGRES_REPLICA_PORT": replica_endpoint[1],
         }
 
         if None in (
@@ -76,11 +88,3 @@ class DatabaseHandler(Object):
             return default
 
         return data
-
-    def is_relation_ready(self) -> bool:
-        """Check if the relation is ready.
-
-        Returns:
-            bool: returns True if the relation is ready.
-        """
-        return self.get_relation_data()["POSTGRES_HOST"] != ""
@@ -0,0 +1,177 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Size the Discourse processes from the resource limits of the workload container."""
+
+import logging
+import math
+import typing
+
+import ops
+from ops.pebble import PathError
+
+logger = logging.getLogger(__name__)
+
+# cgroup v2 and, as a fallback, cgroup v1 files holding the container limits
+CGROUP_V2_CPU_MAX = "/sys/fs/cgroup/cpu.max"
+CGROUP_V2_MEMORY_MAX = "/sys/fs/cgroup/memory.max"
+CGROUP_V1_CPU_QUOTA = "/sys/fs/cgroup/cpu/cpu.cfs_quota_us"
+CGROUP_V1_CPU_PERIOD = "/sys/fs/cgroup/cpu/cpu.cfs_period_us"
+CGROUP_V1_MEMORY_LIMIT = "/sys/fs/cgroup/memory/memory.limit_in_bytes"
+# cgroup v1 reports an unlimited memory as a huge page-aligned value
+CGROUP_V1_UNLIMITED_MEMORY = 1 << 60
+
+# Workers used by Discourse when the limits are unknown, see config/unicorn.conf.rb
+DEFAULT_UNICORN_WORKERS = 3
+MAX_UNICORN_WORKERS = 32
+UNICORN_WORKERS_PER_CPU = 2
+# Expected RSS of a unicorn worker, in megabytes
+UNICORN_WORKER_MEMORY = 400
+# Memory left for the unicorn master and the ops runner, in megabytes
+UNICORN_RESERVED_MEMORY = 600
+
+# Database pool of each Discourse process when not running sidekiq, see config/discourse_defaults.conf
+DEFAULT_DB_POOL = 8
+# Connections of a sidekiq process besides its job threads, for its scheduler and heartbeat
+SIDEKIQ_EXTRA_DB_CONNECTIONS = 3
+
+
+class ResourceLimits(typing.NamedTuple):
+    """Resource limits of the workload container.
+
+    Attributes:
+        cpus: CPU quota, in number of CPUs, or None if unlimited or unknown.
+        memory: Memory limit, in megabytes, or None if unlimited or unknown.
+    """
+
+    cpus: typing.Optional[float]
+    memory: typing.Optional[int]
+
+
+def _read(container: ops.Container, path: str) -> typing.Optional[str]:
+    """Read a file of the container, if it exists.
+
+    Args:
+        container: Workload container.
+        path: Path of the file.
+
+    Returns:
+        Content of the file, stripped, or None if it can't be read.
+    """
+    try:
+        return container.pull(path).read().strip()
+    except PathError:
+        return None
+
+
+def _get_cpus(container: ops.Container) -> typing.Optional[float]:
+    """Get the CPU quota of the container.
+
+    Args:
+        container: Workload container.
+
+    Returns:
+        CPU quota, in number of CPUs, or None if unlimited or unknown.
+    """
+    cpu_max = _read(container, CGROUP_V2_CPU_MAX)
+    if cpu_max is not None:
+        quota, _, period = cpu_max.partition(" ")
+    else:
+        quota = _read(container, CGROUP_V1_CPU_QUOTA) or ""
+        period = _read(container, CGROUP_V1_CPU_PERIOD) or ""
+    if not quota.isdigit() or not period.isdigit() or int(period) == 0:
+        return None
+    return int(quota) / int(period)
+
+
+def _get_memory(container: ops.Container) -> typing.Optional[int]:
+    """Get the memory limit of the container.
+
+    Args:
+        container: Workload container.
+
+    Returns:
+        Memory limit, in megabytes, or None if unlimited or unknown.
+    """
+    memory_max = _read(container, CGROUP_V2_MEMORY_MAX)
+    if memory_max is None:
+        memory_max = _read(container, CGROUP_V1_MEMORY_LIMIT)
+    if not memory_max or not memory_max.isdigit() or int(memory_max) >= CGROUP_V1_UNLIMITED_MEMORY:
+        return None
+    return int(memory_max) // (1024 * 1024)
+
+
+def get_resource_limits(container: ops.Container) -> ResourceLimits:
+    """Get the resource limits of the container from its cgroup.
+
+    Args:
+        container: Workload container.
+
+    Returns:
+        Resource limits of the container, unknown if the container is not reachable.
+    """
+    if not container.can_connect():
+        return ResourceLimits(cpus=None, memory=None)
+    limits = ResourceLimits(cpus=_get_cpus(container), memory=_get_memory(container))
+    logger.debug("Container resource limits: %s", limits)
+    return limits
+
+
+def compute_unicorn_workers(
+    limits: ResourceLimits, reserved_memory: int, extra_worker_memory: int = 0
+) -> int:
+    """Compute the number of unicorn workers fitting in the resource limits.
+
+    Args:
+        limits: Resource limits of the container.
+        reserved_memory: Memory used by the other processes of the container, in megabytes.
+        extra_worker_memory: Memory used by each worker on top of the expected RSS, such as
+            the YJIT code, in megabytes.
+
+    Returns:
+        Number of unicorn workers, between 1 and MAX_UNICORN_WORKERS.
+    """
+    candidates = []
+    if limits.cpus is not None:
+        candidates.append(math.ceil(limits.cpus * UNICORN_WORKERS_PER_CPU))
+    if limits.memory is not None:
+        available = limits.memory - reserved_memory - UNICORN_RESERVED_MEMORY
+        candidates.append(available // (UNICORN_WORKER_MEMORY + extra_worker_memory))
+    if not candidates:
+        return DEFAULT_UNICORN_WORKERS
+    return max(1, min(MAX_UNICORN_WORKERS, *candidates))
+
+
+def compute_db_pool(sidekiq_concurrency: typing.Optional[int]) -> int:
+    """Compute the size of the database connection pool of the Discourse processes.
+
+    Args:
+        sidekiq_concurrency: Threads of the sidekiq processes, None if the unit runs none.
+
+    Returns:
+        Size of the pool, large enough for a connection per sidekiq thread.
+    """
+    if sidekiq_concurrency is None:
+        return DEFAULT_DB_POOL
+    return max(DEFAULT_DB_POOL, sidekiq_concurrency + SIDEKIQ_EXTRA_DB_CONNECTIONS)
+
+
+def compute_unicorn_memory(
+    unicorn_workers: int, reserved_memory: int, extra_worker_memory: int = 0
+) -> int:
+    """Compute the memory needed by the unicorn workers and the other processes.
+
+    Args:
+        unicorn_workers: Number of unicorn workers.
+        reserved_memory: Memory used by the other processes of the container, in megabytes.
+        extra_worker_memory: Memory used by each worker on top of the expected RSS, such as
+            the YJIT code, in megabytes.
+
+    Returns:
+        Memory needed, in megabytes.
+    """
+    return (
+        unicorn_workers * (UNICORN_WORKER_MEMORY + extra_worker_memory)
+        + reserved_memory
+        + UNICORN_RESERVED_MEMORY
+    )
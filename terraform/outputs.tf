@@ -9,12 +9,13 @@ output "app_name" {
 output "requires" {
   description = "Map of requires endpoints."
   value = {
-    redis       = "redis"
-    database    = "database"
-    nginx_route = "nginx-route"
-    logging     = "logging"
-    oauth       = "oauth"
-    saml        = "saml"
+    redis             = "redis"
+    redis_message_bus = "redis-message-bus"
+    database          = "database"
+    nginx_route       = "nginx-route"
+    logging           = "logging"
+    oauth             = "oauth"
+    saml              = "saml"
   }
 }
 
@@ -32,6 +33,7 @@ output "endpoints" {
     metrics_endpoint  = "metrics-endpoint"
     grafana_dashboard = "grafana-dashboard"
     redis             = "redis"
+    redis_message_bus = "redis-message-bus"
     database          = "database"
     nginx_route       = "nginx-route"
     logging           = "logging"
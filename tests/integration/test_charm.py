@@ -5,6 +5,8 @@
 
 import logging
 import re
+import shlex
+import statistics
 from typing import Dict
 
 import jubilant
@@ -42,6 +44,83 @@ def test_prom_exporter_is_up(app: types.App, juju: jubilant.Juju):
     juju.exec(cmd, unit=app.name + "/0", wait=60)
 
 
+# Copies the files of the bootsnap cache shipped in the image, older than the container, to
+# the cache directory of the working directory given as argument
+SNAPSHOT_IMAGE_BOOTSNAP_CACHE = """
+require "etc"
+require "fileutils"
+boot_time = File.read("/proc/stat")[/^btime (\\d+)/, 1].to_i
+ticks = File.read("/proc/1/stat").split(") ").last.split[19].to_i
+started = Time.at(boot_time + ticks / Etc.sysconf(Etc::SC_CLK_TCK).to_f)
+cache = "/srv/discourse/app/tmp/cache/bootsnap"
+shipped = Dir.glob("#{cache}/**/*").select { |f| File.file?(f) && File.mtime(f) < started }
+shipped.each do |file|
+  target = File.join(ARGV[0], "tmp/cache/bootsnap", file.delete_prefix(cache))
+  FileUtils.mkdir_p(File.dirname(target))
+  FileUtils.cp(file, target, preserve: true)
+end
+puts shipped.size
+"""
+# Loads and eager loads Discourse with the environment of the running unicorn master
+LOAD_ENVIRONMENT = """
+master = Dir["/proc/[0-9]*"].find do |process|
+  File.read("#{process}/cmdline").include?("unicorn master")
+rescue SystemCallError
+  false
+end
+File.read("#{master}/environ").split("\\0").each do |variable|
+  name, value = variable.split("=", 2)
+  ENV[name] ||= value
+end
+require "/srv/discourse/app/config/environment"
+"""
+
+
+@pytest.mark.abort_on_fail
+def test_bootsnap_cache_shortens_boot(app: types.App, juju: jubilant.Juju):
+    """
+    arrange: given charm in its initial state, with a copy of the bootsnap cache shipped in
+        the image, leaving out what the running services added to it
+    act: boot Discourse several times from fresh copies of the shipped cache, and from
+        empty caches, alternating which one runs first
+    assert: Discourse boots faster with the shipped cache.
+    """
+    unit = f"{app.name}/0"
+
+    def run(command: str) -> str:
+        """Run a bash command in the workload container."""
+        return juju.ssh(unit, "bash", "-c", shlex.quote(command), container="discourse")
+
+    snapshot_dir = run("mktemp -d").strip()
+    shipped_files = run(
+        f"ruby -e {shlex.quote(SNAPSHOT_IMAGE_BOOTSNAP_CACHE)} {snapshot_dir}"
+    ).strip()
+    assert int(shipped_files.splitlines()[-1]) > 0, "No bootsnap cache shipped in the image"
+
+    def measure(with_shipped_cache: bool) -> int:
+        """Measure the time to boot Discourse from a fresh cache, in milliseconds."""
+        # config/boot.rb sets up bootsnap with a cache relative to the working directory
+        copy_cache = f"cp -a {snapshot_dir}/. $dir && " if with_shipped_cache else ""
+        command = (
+            f"dir=$(mktemp -d) && {copy_cache}chown -R _daemon_ $dir && cd $dir && "
+            "start=$(date +%s%N) && "
+            f"runuser -u _daemon_ -- ruby -e {shlex.quote(LOAD_ENVIRONMENT)} && "
+            "echo $((($(date +%s%N) - start) / 1000000)) && rm -rf $dir"
+        )
+        return int(run(command).strip().splitlines()[-1])
+
+    boot_times: Dict[str, list[int]] = {"shipped": [], "empty": []}
+    modes = [("shipped", True), ("empty", False)]
+    for run_index in range(6):
+        # Alternate the order so that neither mode benefits from the page cache warmed
+        # by the other
+        for mode, with_shipped_cache in modes if run_index % 2 else reversed(modes):
+            boot_times[mode].append(measure(with_shipped_cache))
+    logger.info("Discourse boot times in ms: %s", boot_times)
+
+    assert statistics.median(boot_times["shipped"]) < statistics.median(boot_times["empty"])
+
+
 @pytest.mark.abort_on_fail
 @pytest.mark.usefixtures("app")
 def test_setup_discourse(
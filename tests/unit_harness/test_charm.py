@@ -6,15 +6,30 @@
 # pylint: disable=protected-access
 # Protected access check is disabled in tests as we're injecting test data
 
+import hashlib
+import json
 import secrets
 from unittest.mock import MagicMock, patch
 
 import ops
 import pytest
+import yaml
 from ops.model import ActiveStatus, BlockedStatus, WaitingStatus
 
 from charm import CONTAINER_NAME, DISCOURSE_PATH, SERVICE_NAME
-from constants import DATABASE_NAME
+from constants import (
+    DATABASE_NAME,
+    JEMALLOC_LIBRARY,
+    MIGRATIONS_MANIFEST_FILE,
+    OPS_RUNNER_SERVICE_NAME,
+    OPS_RUNNER_SOCKET_PATH,
+    OPS_RUNNER_UNAVAILABLE_EXIT_CODE,
+    PEER_RELATION_NAME,
+    SCHEMA_VERSION_KEY,
+    SCRIPT_PATH,
+    SIDEKIQ_SERVICE_NAME,
+    WORKLOAD_VERSION_FILE,
+)
 from tests.unit_harness import helpers
 
 
@@ -409,73 +424,55 @@ def test_create_user_success():
     """
     arrange: an email
     act: when the _on_create_user_action method is executed
-    assert: the create user rake command is executed upon failure of the user existence check.
+    assert: a single users:create rake command is executed with the user parameters as JSON.
     """
     harness = helpers.start_harness()
 
     # We catch the exec call that we expect to register it and make sure that the
     # args passed to it are correct.
-    expected_exec_call_was_made = False
+    requests = []
     email = "sample@email.com"
 
-    def mock_create_user(args: ops.testing.ExecArgs) -> None:
-        nonlocal expected_exec_call_was_made
-        expected_exec_call_was_made = True
+    def mock_create_user(args: ops.testing.ExecArgs) -> ops.testing.ExecResult:
         if (
             args.environment != harness.charm._create_discourse_environment_settings()
             or args.working_dir != DISCOURSE_PATH
-            or email not in str(args.stdin)
             or args.user != "_daemon_"
-            or args.timeout != 60
+            or args.timeout != 61
         ):
             raise ValueError(f"{args.command} wasn't made with the correct args.")
+        requests.extend(json.loads(str(args.stdin)))
+        return ops.testing.ExecResult(stdout=json.dumps({"email": email, "status": "created"}))
 
     harness.handle_exec(
         SERVICE_NAME,
-        [f"{DISCOURSE_PATH}/bin/bundle", "exec", "rake", "admin:create"],
+        [f"{DISCOURSE_PATH}/bin/bundle", "exec", "rake", "users:create"],
         handler=mock_create_user,
     )
 
-    stdout = "ERROR: User with email f{email} not found"
-    harness.handle_exec(
-        SERVICE_NAME,
-        [f"{DISCOURSE_PATH}/bin/bundle", "exec", "rake", f"users:exists[{email}]"],
-        result=ops.testing.ExecResult(exit_code=2, stdout=stdout, stderr=""),
-    )
+    output = harness.run_action("create-user", {"email": email, "active": True})
 
-    harness.run_action("create-user", {"email": email})
-    assert expected_exec_call_was_made
+    assert len(requests) == 1
+    assert requests[0]["email"] == email
+    assert requests[0]["password"] == output.results["password"]
+    assert requests[0]["admin"] is False
+    assert requests[0]["active"] is True
+    assert output.results["user"] == email
 
 
 def test_create_user_fail():
     """
-    arrange: an email
+    arrange: an email of an existing user
     act: when the _on_create_user_action method is executed
-    assert: the create user rake command is executed upon failure of the user existence check.
+    assert: the action fails with the users:create rake command reporting the user exists.
     """
     harness = helpers.start_harness()
-
-    # We catch the exec call that we expect to register it and make sure that the
-    # args passed to it are correct.
-    expected_exec_call_was_made = False
     email = "sample@email.com"
 
-    def mock_create_user(args: ops.testing.ExecArgs) -> None:
-        nonlocal expected_exec_call_was_made
-        expected_exec_call_was_made = True
-        if (
-            args.environment != harness.charm._create_discourse_environment_settings()
-            or args.working_dir != DISCOURSE_PATH
-            or email not in str(args.stdin)
-            or args.user != "_daemon_"
-            or args.timeout != 60
-        ):
-            raise ValueError(f"{args.command} wasn't made with the correct args.")
-
     harness.handle_exec(
         SERVICE_NAME,
-        [f"{DISCOURSE_PATH}/bin/bundle", "exec", "rake", "admin:create"],
-        handler=mock_create_user,
+        [f"{DISCOURSE_PATH}/bin/bundle", "exec", "rake", "users:create"],
+        result=json.dumps({"email": email, "status": "exists"}),
     )
 
     try:
@@ -485,6 +482,100 @@ def test_create_user_fail():
         assert e.message == f"User with email {email} already exists"
 
 
+@pytest.mark.parametrize(
+    "users",
+    [
+        pytest.param(
+            '["one@example.com", {"email": "two@example.com", "admin": true}, '
+            '{"email": "three@example.com", "active": false}]',
+            id="json",
+        ),
+        pytest.param(
+            "email,admin,active\none@example.com\ntwo@example.com,yes\nthree@example.com,no,no\n",
+            id="csv",
+        ),
+    ],
+)
+def test_create_users(users: str):
+    """
+    arrange: a list of users to create
+    act: when the create-users action is executed
+    assert: the users are created in a single users:create rake command, the progress is
+        logged and the results map the emails to their status and password.
+    """
+    harness = helpers.start_harness()
+    requests = []
+
+    def mock_create_users(args: ops.testing.ExecArgs) -> ops.testing.ExecResult:
+        requests.extend(json.loads(str(args.stdin)))
+        lines = [
+            {"email": "one@example.com", "status": "created"},
+            {"email": "two@example.com", "status": "exists"},
+            {"email": "three@example.com", "status": "failed", "errors": ["Email is invalid"]},
+            {"progress": {"done": 3, "total": 3}},
+        ]
+        # Discourse may also log lines that look like JSON
+        stdout = "{deprecated} option\n" + "".join(f"{json.dumps(line)}\n" for line in lines)
+        return ops.testing.ExecResult(stdout=stdout)
+
+    harness.handle_exec(
+        SERVICE_NAME,
+        [f"{DISCOURSE_PATH}/bin/bundle", "exec", "rake", "users:create"],
+        handler=mock_create_users,
+    )
+
+    output = harness.run_action("create-users", {"users": users})
+
+    assert [(r["email"], r["admin"], r["active"]) for r in requests] == [
+        ("one@example.com", False, True),
+        ("two@example.com", True, True),
+        ("three@example.com", False, False),
+    ]
+    assert output.logs == ["Processed 3/3"]
+    assert json.loads(output.results["users"]) == {
+        "one@example.com": {"status": "created", "password": requests[0]["password"]},
+        "two@example.com": {"status": "exists"},
+        "three@example.com": {"status": "failed", "errors": ["Email is invalid"]},
+    }
+    assert output.results["created"] == 1
+    assert output.results["existing"] == 1
+    assert output.results["failed"] == 1
+
+
+@pytest.mark.parametrize(
+    "users, message",
+    [
+        pytest.param(
+            "one@example.com,maybe", "Invalid user line: one@example.com,maybe", id="csv flag"
+        ),
+        pytest.param(
+            '[{"email": "one@example.com", "admin": "false"}]',
+            "Invalid user: {'email': 'one@example.com', 'admin': 'false'}",
+            id="json string flag",
+        ),
+    ],
+)
+def test_create_users_invalid_list(users: str, message: str):
+    """
+    arrange: an invalid list of users
+    act: when the create-users action is executed
+    assert: the action fails without running the rake command.
+    """
+    harness = helpers.start_harness()
+    create_calls: list[ops.testing.ExecArgs] = []
+    harness.handle_exec(
+        SERVICE_NAME,
+        [f"{DISCOURSE_PATH}/bin/bundle", "exec", "rake", "users:create"],
+        handler=create_calls.append,
+    )
+
+    with pytest.raises(ops.testing.ActionFailed) as exc:
+        harness.run_action("create-users", {"users": users})
+
+    assert exc.value.message == message
+    assert not create_calls
+
+
 def test_anonymize_user():
     """
     arrange: set up discourse
@@ -519,6 +610,305 @@ def test_anonymize_user():
     assert expected_exec_call_was_made
 
 
+@pytest.mark.parametrize(
+    "action, param, task, key, done_status",
+    [
+        pytest.param(
+            "anonymize-users",
+            "usernames",
+            "users:anonymize_batch",
+            "username",
+            "anonymized",
+            id="anonymize",
+        ),
+        pytest.param(
+            "promote-users", "emails", "users:promote_batch", "email", "promoted", id="promote"
+        ),
+    ],
+)
+def test_bulk_user_actions(action: str, param: str, task: str, key: str, done_status: str):
+    """
+    arrange: set up discourse
+    act: execute a bulk user action with a list of users
+    assert: the users are processed in a single rake command, a failure for a user is
+        reported without failing the action, and the progress is logged.
+    """
+    harness = helpers.start_harness()
+    requests = []
+
+    def bulk_handler(args: ops.testing.ExecArgs) -> ops.testing.ExecResult:
+        requests.append(json.loads(str(args.stdin)))
+        lines = [
+            {key: "one", "status": done_status},
+            {key: "two", "status": "not-found"},
+            {key: "three", "status": "failed", "errors": ["boom"]},
+            {"progress": {"done": 3, "total": 3}},
+        ]
+        return ops.testing.ExecResult(stdout="".join(f"{json.dumps(line)}\n" for line in lines))
+
+    harness.handle_exec(
+        SERVICE_NAME, [f"{DISCOURSE_PATH}/bin/bundle", "exec", "rake", task], handler=bulk_handler
+    )
+
+    output = harness.run_action(action, {param: "one, two\nthree one"})
+
+    assert requests == [["one", "two", "three"]]
+    assert output.logs == ["Processed 3/3"]
+    assert json.loads(output.results["users"]) == {
+        "one": {"status": done_status},
+        "two": {"status": "not-found"},
+        "three": {"status": "failed", "errors": ["boom"]},
+    }
+    assert output.results[done_status] == 1
+    assert output.results["not-found"] == 1
+    assert output.results["failed"] == 1
+
+
+def test_anonymize_user_through_ops_runner():
+    """
+    arrange: set up discourse with the ops runner listening
+    act: execute the _on_anonymize_user_action method
+    assert: the rake task is sent to the ops runner instead of being executed with bundle.
+    """
+    harness = helpers.start_harness()
+    username = "someusername"
+    container = harness.charm.unit.get_container(CONTAINER_NAME)
+    container.push(OPS_RUNNER_SOCKET_PATH, "", make_dirs=True)
+
+    requests = []
+
+    def ops_client_handler(args: ops.testing.ExecArgs) -> ops.testing.ExecResult:
+        requests.append(json.loads(str(args.stdin)))
+        return ops.testing.ExecResult(stdout=f"User {username} anonymized\n")
+
+    harness.handle_exec(
+        SERVICE_NAME,
+        [f"{SCRIPT_PATH}/ops_client.rb", OPS_RUNNER_SOCKET_PATH],
+        handler=ops_client_handler,
+    )
+    harness.handle_exec(
+        SERVICE_NAME,
+        [f"{DISCOURSE_PATH}/bin/bundle"],
+        result=ops.testing.ExecResult(exit_code=1),
+    )
+
+    output = harness.run_action("anonymize-user", {"username": username})
+
+    assert output.results == {"user": username}
+    assert requests == [{"command": "rake", "args": [f"users:anonymize[{username}]"], "stdin": ""}]
+
+
+def test_ops_runner_unavailable_falls_back_to_exec():
+    """
+    arrange: set up discourse with a stale ops runner socket
+    act: execute the _on_anonymize_user_action method
+    assert: the rake task is executed with bundle when the ops runner can't be reached.
+    """
+    harness = helpers.start_harness()
+    username = "someusername"
+    container = harness.charm.unit.get_container(CONTAINER_NAME)
+    container.push(OPS_RUNNER_SOCKET_PATH, "", make_dirs=True)
+
+    harness.handle_exec(
+        SERVICE_NAME,
+        [f"{SCRIPT_PATH}/ops_client.rb"],
+        result=ops.testing.ExecResult(exit_code=OPS_RUNNER_UNAVAILABLE_EXIT_CODE),
+    )
+    expected_exec_call_was_made = False
+
+    def bundle_handler(args: ops.testing.ExecArgs) -> None:
+        nonlocal expected_exec_call_was_made
+        expected_exec_call_was_made = True
+        if args.environment != harness.charm._create_discourse_environment_settings():
+            raise ValueError(f"{args.command} wasn't made with the correct args.")
+
+    harness.handle_exec(
+        SERVICE_NAME,
+        [f"{DISCOURSE_PATH}/bin/bundle", "exec", "rake", f"users:anonymize[{username}]"],
+        handler=bundle_handler,
+    )
+
+    harness.run_action("anonymize-user", {"username": username})
+
+    assert expected_exec_call_was_made
+
+
+def test_ops_runner_service_planned():
+    """
+    arrange: given a deployed discourse charm with all the required relations
+    act: trigger the pebble ready event
+    assert: the ops runner service is planned with the same environment as discourse.
+    """
+    harness = helpers.start_harness()
+    harness.container_pebble_ready(CONTAINER_NAME)
+
+    services = harness.get_container_pebble_plan(CONTAINER_NAME).services
+    assert services[OPS_RUNNER_SERVICE_NAME].command == f"{SCRIPT_PATH}/ops_runner.rb"
+    assert services[OPS_RUNNER_SERVICE_NAME].environment == services[SERVICE_NAME].environment
+
+
+@pytest.mark.parametrize(
+    "role, enabled_service, disabled_service, unicorn_sidekiqs",
+    [
+        pytest.param("all", SERVICE_NAME, SIDEKIQ_SERVICE_NAME, "1", id="all"),
+        pytest.param("web", SERVICE_NAME, SIDEKIQ_SERVICE_NAME, "0", id="web"),
+        pytest.param("worker", SIDEKIQ_SERVICE_NAME, SERVICE_NAME, "0", id="worker"),
+    ],
+)
+def test_role_services(
+    role: str, enabled_service: str, disabled_service: str, unicorn_sidekiqs: str
+):
+    """
+    arrange: given a deployed discourse charm with all the required relations
+    act: set the role configuration
+    assert: only the services of the role are enabled and running, and sidekiq only runs in
+        the unicorn master for units with all the roles.
+    """
+    harness = helpers.start_harness()
+    harness.container_pebble_ready(CONTAINER_NAME)
+
+    harness.update_config({"role": role})
+
+    plan = harness.get_container_pebble_plan(CONTAINER_NAME)
+    assert plan.services[enabled_service].startup == "enabled"
+    assert plan.services[disabled_service].startup == "disabled"
+    assert plan.services[SERVICE_NAME].environment["UNICORN_SIDEKIQS"] == unicorn_sidekiqs
+    container = harness.charm.unit.get_container(CONTAINER_NAME)
+    assert container.get_service(enabled_service).is_running()
+    assert not container.get_service(disabled_service).is_running()
+    ready_check = plan.checks["discourse-ready"]
+    if role == "worker":
+        assert ready_check.exec["command"] == f"{SCRIPT_PATH}/sidekiq_check.sh"
+    else:
+        assert ready_check.http["url"].endswith("/srv/status")
+    assert plan.checks["discourse-sidekiq-ready"].startup == ops.pebble.CheckStartup.DISABLED
+
+
+def test_invalid_role():
+    """
+    arrange: given a deployed discourse charm
+    act: set an invalid role configuration
+    assert: the unit is blocked.
+    """
+    harness = helpers.start_harness()
+
+    harness.update_config({"role": "scheduler"})
+
+    assert harness.model.unit.status == BlockedStatus("role must be one of: all, web, worker")
+
+
+@pytest.mark.parametrize(
+    "role, queue_weights, embedded",
+    [
+        pytest.param("all", "critical:8,default:4,low:2,ultra_low:1", True, id="default"),
+        pytest.param("all", "critical:8, default:1, low:1, ultra_low:1", False, id="custom"),
+        pytest.param("worker", "critical:8,default:4,low:2,ultra_low:1", False, id="worker"),
+    ],
+)
+def test_sidekiq_configuration(role: str, queue_weights: str, embedded: bool):
+    """
+    arrange: given a deployed discourse charm with all the required relations
+    act: set the sidekiq processes, concurrency and queue weights configuration
+    assert: the sidekiq settings are set in the environment, and sidekiq runs in the unicorn
+        master only with the default queue weights.
+    """
+    harness = helpers.start_harness()
+    harness.container_pebble_ready(CONTAINER_NAME)
+
+    harness.update_config(
+        {
+            "role": role,
+            "sidekiq_processes": 2,
+            "sidekiq_concurrency": 10,
+            "sidekiq_queue_weights": queue_weights,
+        }
+    )
+
+    plan = harness.get_container_pebble_plan(CONTAINER_NAME)
+    environment = plan.services[SIDEKIQ_SERVICE_NAME].environment
+    assert environment["DISCOURSE_SIDEKIQ_WORKERS"] == "10"
+    assert environment["SIDEKIQ_PROCESSES"] == "2"
+    assert environment["SIDEKIQ_QUEUES"] == " ".join(
+        pair.strip().replace(":", ",") for pair in queue_weights.split(",")
+    )
+    assert environment["UNICORN_SIDEKIQS"] == ("2" if embedded else "0")
+    assert plan.services[SIDEKIQ_SERVICE_NAME].startup == ("disabled" if embedded else "enabled")
+
+
+def test_standalone_sidekiq_beside_unicorn():
+    """
+    arrange: given a deployed discourse charm with all the roles
+    act: customize the sidekiq queue weights, then restore the default ones
+    assert: the standalone sidekiq runs next to unicorn with a check of its own, and both are
+        stopped once sidekiq runs in the unicorn master again.
+    """
+    harness = helpers.start_harness()
+    harness.container_pebble_ready(CONTAINER_NAME)
+    container = harness.charm.unit.get_container(CONTAINER_NAME)
+
+    harness.update_config({"sidekiq_queue_weights": "critical:8,default:1,low:1,ultra_low:1"})
+
+    sidekiq_check = harness.get_container_pebble_plan(CONTAINER_NAME).checks[
+        "discourse-sidekiq-ready"
+    ]
+    assert sidekiq_check.exec["command"] == f"{SCRIPT_PATH}/sidekiq_check.sh"
+    assert container.get_service(SERVICE_NAME).is_running()
+    assert container.get_service(SIDEKIQ_SERVICE_NAME).is_running()
+    assert container.get_check("discourse-sidekiq-ready").status == ops.pebble.CheckStatus.UP
+
+    harness.update_config({"sidekiq_queue_weights": "critical:8,default:4,low:2,ultra_low:1"})
+
+    assert container.get_service(SERVICE_NAME).is_running()
+    assert not container.get_service(SIDEKIQ_SERVICE_NAME).is_running()
+    assert container.get_check("discourse-sidekiq-ready").status == ops.pebble.CheckStatus.INACTIVE
+
+
+@pytest.mark.parametrize(
+    "config, message",
+    [
+        pytest.param(
+            {"sidekiq_processes": 0},
+            "sidekiq_processes must be a positive integer",
+            id="processes",
+        ),
+        pytest.param(
+            {"sidekiq_concurrency": -1},
+            "sidekiq_concurrency must be a positive integer",
+            id="concurrency",
+        ),
+        pytest.param(
+            {"sidekiq_queue_weights": "critical:8,default:4,low:2"},
+            "sidekiq_queue_weights must set a positive weight for each of: "
+            "critical, default, low, ultra_low",
+            id="missing queue",
+        ),
+        pytest.param(
+            {"sidekiq_queue_weights": "critical:8,default:0,low:2,ultra_low:1"},
+            "sidekiq_queue_weights must set a positive weight for each of: "
+            "critical, default, low, ultra_low",
+            id="zero weight",
+        ),
+        pytest.param(
+            {"sidekiq_queue_weights": "critical:8,default:4,low:2,ultra_low:1,mailers:1"},
+            "sidekiq_queue_weights must set a positive weight for each of: "
+            "critical, default, low, ultra_low",
+            id="unknown queue",
+        ),
+    ],
+)
+def test_invalid_sidekiq_configuration(config: dict, message: str):
+    """
+    arrange: given a deployed discourse charm
+    act: set an invalid sidekiq configuration
+    assert: the unit is blocked.
+    """
+    harness = helpers.start_harness()
+
+    harness.update_config(config)
+
+    assert harness.model.unit.status == BlockedStatus(message)
+
+
 def test_sidekiq_env_variable():
     """
     arrange: given a deployed discourse charm with all the required relations
@@ -541,6 +931,75 @@ def test_sidekiq_env_variable():
     assert "500" in plan_after_set_config["UNICORN_SIDEKIQ_MAX_RSS"]
 
 
+def test_web_worker_max_memory():
+    """
+    arrange: given a deployed discourse charm with all the required relations
+    act: set the web_worker_max_memory configuration
+    assert: the maximum RSS of the web workers is set in the environment.
+    """
+    harness = helpers.start_harness()
+
+    harness.update_config({"web_worker_max_memory": 800})
+
+    environment = (
+        harness.get_container_pebble_plan(CONTAINER_NAME).services[SERVICE_NAME].environment
+    )
+    assert environment["UNICORN_WORKER_MAX_RSS"] == "800"
+
+
+def test_unchanged_config_skips_replan_and_rails_runner():
+    """
+    arrange: given an active discourse charm with all the required relations
+    act: trigger config changed twice, changing force_https in between
+    assert: replan and the force_https rails runner only happen when something changed
+    """
+    harness = helpers.start_harness()
+    harness.container_pebble_ready(CONTAINER_NAME)
+    assert harness.model.unit.status == ActiveStatus()
+
+    force_https_calls = []
+    harness.handle_exec(
+        SERVICE_NAME,
+        [f"{DISCOURSE_PATH}/bin/rails", "runner"],
+        handler=lambda args: force_https_calls.append(args.command[-1]),
+    )
+    container = harness.charm.unit.get_container(CONTAINER_NAME)
+    replan_services = MagicMock(wraps=container.pebble.replan_services)
+    container.pebble.replan_services = replan_services  # type: ignore[method-assign]
+
+    harness.charm.on.config_changed.emit()
+
+    assert force_https_calls == []
+    replan_services.assert_not_called()
+    assert harness.model.unit.status == ActiveStatus()
+
+    harness.update_config({"force_https": True})
+
+    assert force_https_calls == ["SiteSetting.force_https=true"]
+    replan_services.assert_called_once()
+
+
+def test_unchanged_layer_with_pebble_defaults_skips_replan(monkeypatch: pytest.MonkeyPatch):
+    """
+    arrange: given an active discourse charm whose plan has the defaults Pebble fills in
+    act: trigger config changed without changing anything
+    assert: the services are not replanned.
+    """
+    harness = helpers.start_harness()
+    harness.container_pebble_ready(CONTAINER_NAME)
+    container = harness.charm.unit.get_container(CONTAINER_NAME)
+    plan = container.get_plan().to_dict()
+    for check in plan.get("checks", {}).values():
+        check.update({"period": "10s", "timeout": "3s", "threshold": 3})
+    monkeypatch.setattr(container, "get_plan", lambda: ops.pebble.Plan(yaml.safe_dump(plan)))
+    replan_services = MagicMock(wraps=container.pebble.replan_services)
+    container.pebble.replan_services = replan_services  # type: ignore[method-assign]
+
+    harness.charm.on.config_changed.emit()
+
+    replan_services.assert_not_called()
+
+
 def test_handle_pebble_ready_event():
     """
     arrange: given a deployed discourse charm with all the required relations
@@ -666,22 +1125,832 @@ def test_start_when_not_leader():
     assert all(expected_exec_call_was_made.values())
 
 
-@pytest.mark.parametrize(
-    "relation_data, should_be_ready",
-    [
-        (
-            {
-                "database": DATABASE_NAME,
-                "endpoints": "dbhost:5432,dbhost-2:5432",
-                "password": secrets.token_hex(16),
-                "username": "someuser",
-            },
-            True,
-        ),
-        (
-            {
-                "database": DATABASE_NAME,
-                "endpoints": "foo",
+def test_database_replica():
+    """
+    arrange: given an active discourse charm
+    act: add read-only endpoints to the database relation data
+    assert: the first replica is set in the environment without checking the migrations.
+    """
+    harness = helpers.start_harness()
+    harness.container_pebble_ready(CONTAINER_NAME)
+    migration_checks: list[ops.testing.ExecArgs] = []
+    harness.handle_exec(SERVICE_NAME, ["psql"], handler=migration_checks.append)
+    harness.handle_exec(
+        SERVICE_NAME,
+        [f"{DISCOURSE_PATH}/bin/bundle", "exec", "rake", "--trace", "db:migrate"],
+        handler=migration_checks.append,
+    )
+
+    harness.update_relation_data(
+        harness.db_relation_id,
+        "postgresql",
+        {"read-only-endpoints": "replica-1:5433,replica-2:5433"},
+    )
+
+    environment = (
+        harness.get_container_pebble_plan(CONTAINER_NAME).services[SERVICE_NAME].environment
+    )
+    assert environment["DISCOURSE_DB_HOST"] == "dbhost"
+    assert environment["DISCOURSE_DB_REPLICA_HOST"] == "replica-1"
+    assert environment["DISCOURSE_DB_REPLICA_PORT"] == "5433"
+    assert not migration_checks
+
+
+FIXTURES_DIGEST = hashlib.sha256(b"fixtures").hexdigest()
+
+
+@pytest.mark.parametrize(
+    "probe_exit_code, applied_migrations, should_migrate, expected_status",
+    [
+        pytest.param(
+            0,
+            f"20260101000000\nfixtures:{FIXTURES_DIGEST}\n",
+            False,
+            ActiveStatus(),
+            id="reachable",
+        ),
+        pytest.param(
+            2,
+            "",
+            False,
+            WaitingStatus("Waiting for database at dbhost-3:5432"),
+            id="unreachable",
+        ),
+        pytest.param(0, "", True, ActiveStatus(), id="pending migrations"),
+    ],
+)
+def test_database_endpoints_changed_skips_migrations(
+    probe_exit_code: int, applied_migrations: str, should_migrate: bool, expected_status
+):
+    """
+    arrange: given an active discourse charm leader with the migrations manifest built in
+        the image
+    act: change the primary endpoint of the database relation
+    assert: the services are replanned with the new host, without running the migrations
+        unless the database behind it has some pending nor reapplying the site settings, and
+        the unit waits if the new host can't be reached.
+    """
+    harness = helpers.start_harness()
+    harness.container_pebble_ready(CONTAINER_NAME)
+    harness.disable_hooks()
+    harness.set_leader(True)
+    harness.enable_hooks()
+    harness.charm.unit.get_container(CONTAINER_NAME).push(
+        MIGRATIONS_MANIFEST_FILE, f"20260101000000\nfixtures:{FIXTURES_DIGEST}\n", make_dirs=True
+    )
+    psql_queries: list[str] = []
+    migrate_calls: list[ops.testing.ExecArgs] = []
+    runner_calls: list[list[str]] = []
+
+    def psql_handler(args: ops.testing.ExecArgs) -> ops.testing.ExecResult:
+        psql_queries.append(args.command[-1])
+        return ops.testing.ExecResult(exit_code=probe_exit_code, stdout=applied_migrations)
+
+    harness.handle_exec(SERVICE_NAME, ["psql"], handler=psql_handler)
+    harness.handle_exec(
+        SERVICE_NAME,
+        [f"{DISCOURSE_PATH}/bin/bundle", "exec", "rake", "--trace", "db:migrate"],
+        handler=migrate_calls.append,
+    )
+    harness.handle_exec(
+        SERVICE_NAME,
+        [f"{DISCOURSE_PATH}/bin/rails", "runner"],
+        handler=lambda args: runner_calls.append(args.command),
+    )
+
+    harness.update_relation_data(
+        harness.db_relation_id, "postgresql", {"endpoints": "dbhost-3:5432"}
+    )
+
+    environment = (
+        harness.get_container_pebble_plan(CONTAINER_NAME).services[SERVICE_NAME].environment
+    )
+    assert environment["DISCOURSE_DB_HOST"] == "dbhost-3"
+    assert psql_queries[0] == "SELECT 1"
+    assert bool(migrate_calls) == should_migrate
+    assert not runner_calls
+    assert harness.model.unit.status == expected_status
+
+
+@pytest.mark.parametrize(
+    "applied_migrations, should_migrate",
+    [
+        pytest.param(
+            f"20260101000000\n20260102000000\nfixtures:{FIXTURES_DIGEST}\n",
+            False,
+            id="up to date",
+        ),
+        pytest.param(f"20260101000000\nfixtures:{FIXTURES_DIGEST}\n", True, id="pending"),
+        pytest.param("20260101000000\n20260102000000\nfixtures:0\n", True, id="new fixtures"),
+        pytest.param("20260101000000\n20260102000000\n", True, id="never seeded"),
+    ],
+)
+def test_migrations_skipped_when_up_to_date(applied_migrations: str, should_migrate: bool):
+    """
+    arrange: given a deployed discourse charm with the migrations manifest built in the image
+    act: trigger the start event on a leader unit
+    assert: db:migrate only runs if a shipped migration is missing from schema_migrations or
+        the shipped fixtures were not seeded, whose digest is recorded once migrated.
+    """
+    harness = helpers.start_harness(run_initial_hooks=False)
+    migrate_calls = []
+    psql_calls = []
+
+    def psql_handler(args: ops.testing.ExecArgs) -> ops.testing.ExecResult:
+        psql_calls.append(args)
+        return ops.testing.ExecResult(stdout=applied_migrations)
+
+    harness.handle_exec(SERVICE_NAME, ["psql"], handler=psql_handler)
+    harness.handle_exec(
+        SERVICE_NAME,
+        [f"{DISCOURSE_PATH}/bin/bundle", "exec", "rake", "--trace", "db:migrate"],
+        handler=lambda args: migrate_calls.append(args.command),
+    )
+
+    harness.disable_hooks()
+    harness.set_leader(True)
+    harness.enable_hooks()
+    harness.set_can_connect(CONTAINER_NAME, True)
+    harness.charm.unit.get_container(CONTAINER_NAME).push(
+        MIGRATIONS_MANIFEST_FILE,
+        f"20260101000000\n20260102000000\nfixtures:{FIXTURES_DIGEST}\n",
+        make_dirs=True,
+    )
+    harness.container_pebble_ready(SERVICE_NAME)
+    harness.charm.on.start.emit()
+    harness.framework.reemit()
+
+    assert psql_calls
+    assert psql_calls[0].environment["PGDATABASE"] == DATABASE_NAME
+    assert bool(migrate_calls) == should_migrate
+    recorded = any(
+        "ar_internal_metadata" in args.command[-1] and FIXTURES_DIGEST in args.command[-1]
+        for args in psql_calls
+    )
+    assert recorded == should_migrate
+
+
+def _schema_version(manifest: str, db_relation_id: int, database: str = DATABASE_NAME) -> str:
+    """Compute the schema version a leader publishes for a manifest and a database.
+
+    Args:
+        manifest: Content of the migrations manifest.
+        db_relation_id: Id of the database relation.
+        database: Name of the database.
+
+    Returns:
+        The schema version.
+    """
+    inputs = {"manifest": manifest, "database": [db_relation_id, database]}
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+def test_leader_publishes_schema_version():
+    """
+    arrange: given a deployed discourse charm with the migrations manifest built in the image
+    act: trigger the start event on a leader unit
+    assert: the migrations are executed and the schema version is published to the peers.
+    """
+    harness = helpers.start_harness(run_initial_hooks=False)
+    manifest = "20260101000000\n20260102000000\n"
+    migrate_calls = []
+    harness.handle_exec(
+        SERVICE_NAME,
+        [f"{DISCOURSE_PATH}/bin/bundle", "exec", "rake", "--trace", "db:migrate"],
+        handler=lambda args: migrate_calls.append(args.command),
+    )
+    peer_relation_id = harness.add_relation(PEER_RELATION_NAME, harness.charm.app.name)
+
+    harness.disable_hooks()
+    harness.set_leader(True)
+    harness.enable_hooks()
+    harness.set_can_connect(CONTAINER_NAME, True)
+    harness.charm.unit.get_container(CONTAINER_NAME).push(
+        MIGRATIONS_MANIFEST_FILE, manifest, make_dirs=True
+    )
+    harness.container_pebble_ready(SERVICE_NAME)
+    harness.charm.on.start.emit()
+    harness.framework.reemit()
+
+    assert migrate_calls
+    app_data = harness.get_relation_data(peer_relation_id, harness.charm.app.name)
+    assert app_data[SCHEMA_VERSION_KEY] == _schema_version(manifest, harness.db_relation_id)
+
+
+def test_non_leader_waits_for_leader_migrations():
+    """
+    arrange: given a deployed discourse charm with the migrations manifest built in the image
+    act: trigger the start event on a non leader unit, then publish the schema version from
+        the leader.
+    assert: the unit waits for the leader and completes its setup without running the
+        migrations once the leader published the schema version.
+    """
+    harness = helpers.start_harness(run_initial_hooks=False)
+    manifest = "20260101000000\n20260102000000\n"
+    migrate_calls = []
+    harness.handle_exec(
+        SERVICE_NAME,
+        [f"{DISCOURSE_PATH}/bin/bundle", "exec", "rake", "--trace", "db:migrate"],
+        handler=lambda args: migrate_calls.append(args.command),
+    )
+    peer_relation_id = harness.add_relation(PEER_RELATION_NAME, harness.charm.app.name)
+
+    harness.set_leader(False)
+    harness.set_can_connect(CONTAINER_NAME, True)
+    harness.charm.unit.get_container(CONTAINER_NAME).push(
+        MIGRATIONS_MANIFEST_FILE, manifest, make_dirs=True
+    )
+    harness.container_pebble_ready(SERVICE_NAME)
+    harness.charm.on.start.emit()
+    harness.framework.reemit()
+
+    assert harness.model.unit.status == WaitingStatus("Waiting for leader to execute migrations")
+    assert not harness.charm._is_setup_completed()
+
+    harness.update_relation_data(
+        peer_relation_id,
+        harness.charm.app.name,
+        {SCHEMA_VERSION_KEY: _schema_version(manifest, harness.db_relation_id)},
+    )
+
+    assert harness.charm._is_setup_completed()
+    assert not migrate_calls
+
+
+@pytest.mark.parametrize(
+    "published_database, applied_migrations, expected_completed",
+    [
+        pytest.param("other", "", False, id="other database"),
+        pytest.param("other", "20260101000000\n20260102000000\n", True, id="up to date"),
+        pytest.param("", "20260101000000\n20260102000000\n", True, id="nothing published"),
+    ],
+)
+def test_non_leader_migrations_barrier(
+    published_database: str, applied_migrations: str, expected_completed: bool
+):
+    """
+    arrange: given a non leader unit with the migrations manifest built in the image
+    act: publish the schema version of the image from the leader for another database, or
+        nothing, and trigger the start event.
+    assert: the unit only completes its setup without the leader if the database has no
+        pending migrations, without running the migrations itself.
+    """
+    harness = helpers.start_harness(run_initial_hooks=False)
+    manifest = "20260101000000\n20260102000000\n"
+    migrate_calls = []
+    harness.handle_exec(
+        SERVICE_NAME,
+        [f"{DISCOURSE_PATH}/bin/bundle", "exec", "rake", "--trace", "db:migrate"],
+        handler=lambda args: migrate_calls.append(args.command),
+    )
+    harness.handle_exec(SERVICE_NAME, ["psql"], result=applied_migrations)
+    peer_relation_id = harness.add_relation(PEER_RELATION_NAME, harness.charm.app.name)
+    if published_database:
+        schema_version = _schema_version(manifest, harness.db_relation_id, published_database)
+        harness.update_relation_data(
+            peer_relation_id, harness.charm.app.name, {SCHEMA_VERSION_KEY: schema_version}
+        )
+
+    harness.set_leader(False)
+    harness.set_can_connect(CONTAINER_NAME, True)
+    harness.charm.unit.get_container(CONTAINER_NAME).push(
+        MIGRATIONS_MANIFEST_FILE, manifest, make_dirs=True
+    )
+    harness.container_pebble_ready(SERVICE_NAME)
+    harness.charm.on.start.emit()
+    harness.framework.reemit()
+
+    assert harness.charm._is_setup_completed() == expected_completed
+    assert not migrate_calls
+
+
+def test_non_leader_waiting_for_migrations_skips_site_settings():
+    """
+    arrange: given a non leader unit waiting for the leader to execute the migrations
+    act: change the force_https configuration, then publish the schema version from the leader
+    assert: the site settings are not applied until the leader migrated the schema.
+    """
+    harness = helpers.start_harness(run_initial_hooks=False)
+    manifest = "20260101000000\n20260102000000\n"
+    runner_calls = []
+    harness.handle_exec(
+        SERVICE_NAME,
+        [f"{DISCOURSE_PATH}/bin/rails", "runner"],
+        handler=lambda args: runner_calls.append(args.command[-1]),
+    )
+    peer_relation_id = harness.add_relation(PEER_RELATION_NAME, harness.charm.app.name)
+    harness.set_leader(False)
+    harness.set_can_connect(CONTAINER_NAME, True)
+    harness.charm.unit.get_container(CONTAINER_NAME).push(
+        MIGRATIONS_MANIFEST_FILE, manifest, make_dirs=True
+    )
+    harness.container_pebble_ready(SERVICE_NAME)
+    harness.charm.on.start.emit()
+    harness.framework.reemit()
+
+    harness.update_config({"force_https": True})
+
+    assert harness.model.unit.status == WaitingStatus("Waiting for leader to execute migrations")
+    assert not [call for call in runner_calls if call.startswith("SiteSetting")]
+
+    harness.update_relation_data(
+        peer_relation_id,
+        harness.charm.app.name,
+        {SCHEMA_VERSION_KEY: _schema_version(manifest, harness.db_relation_id)},
+    )
+
+    assert [call for call in runner_calls if call.startswith("SiteSetting")] == [
+        "SiteSetting.force_https=true"
+    ]
+
+
+@pytest.mark.parametrize(
+    "unicorn_workers, cgroup_files, expected_workers",
+    [
+        pytest.param("5", {}, "5", id="fixed"),
+        pytest.param("auto", {}, "3", id="unknown limits"),
+        pytest.param(
+            "auto",
+            {"/sys/fs/cgroup/cpu.max": "max 100000", "/sys/fs/cgroup/memory.max": "max"},
+            "3",
+            id="unlimited",
+        ),
+        pytest.param(
+            "auto",
+            {
+                "/sys/fs/cgroup/cpu.max": "200000 100000",
+                "/sys/fs/cgroup/memory.max": str(8 * 1024**3),
+            },
+            "4",
+            id="cpu bound",
+        ),
+        pytest.param(
+            "auto",
+            {
+                "/sys/fs/cgroup/cpu.max": "800000 100000",
+                "/sys/fs/cgroup/memory.max": str(3 * 1024**3),
+            },
+            "3",
+            id="memory bound",
+        ),
+        pytest.param(
+            "auto",
+            {
+                "/sys/fs/cgroup/cpu/cpu.cfs_quota_us": "50000",
+                "/sys/fs/cgroup/cpu/cpu.cfs_period_us": "100000",
+                "/sys/fs/cgroup/memory/memory.limit_in_bytes": str(1024**3),
+            },
+            "1",
+            id="cgroup v1",
+        ),
+    ],
+)
+def test_unicorn_workers(unicorn_workers: str, cgroup_files: dict, expected_workers: str):
+    """
+    arrange: given a charm with the container resource limits in its cgroup files
+    act: set the unicorn_workers configuration
+    assert: the number of unicorn workers is set in the service environment.
+    """
+    harness = helpers.start_harness()
+    container = harness.charm.unit.get_container(CONTAINER_NAME)
+    for path, content in cgroup_files.items():
+        container.push(path, content, make_dirs=True)
+    # The limits are read once per dispatch, as they don't change during the pod lifetime
+    harness.charm._environment_snapshot = None
+
+    harness.update_config({"unicorn_workers": unicorn_workers})
+
+    plan = harness.get_container_pebble_plan(CONTAINER_NAME)
+    assert plan.services[SERVICE_NAME].environment["UNICORN_WORKERS"] == expected_workers
+
+
+def test_invalid_unicorn_workers():
+    """
+    arrange: given a deployed discourse charm
+    act: set an invalid unicorn_workers configuration
+    assert: the unit is blocked.
+    """
+    harness = helpers.start_harness()
+
+    harness.update_config({"unicorn_workers": "many"})
+
+    assert harness.model.unit.status == BlockedStatus(
+        "unicorn_workers must be 'auto' or a positive integer"
+    )
+
+
+@pytest.mark.parametrize(
+    "role, sidekiq_concurrency, expected_pool",
+    [
+        pytest.param("all", 5, "8", id="default"),
+        pytest.param("all", 20, "23", id="sidekiq threads"),
+        pytest.param("web", 20, "8", id="web"),
+        pytest.param("worker", 20, "23", id="worker"),
+    ],
+)
+def test_db_pool(role: str, sidekiq_concurrency: int, expected_pool: str):
+    """
+    arrange: given a deployed discourse charm with all the required relations
+    act: set the role and sidekiq concurrency configurations
+    assert: the database pool fits the sidekiq threads of the units running sidekiq.
+    """
+    harness = helpers.start_harness()
+
+    harness.update_config({"role": role, "sidekiq_concurrency": sidekiq_concurrency})
+
+    plan = harness.get_container_pebble_plan(CONTAINER_NAME)
+    assert plan.services[SERVICE_NAME].environment["DISCOURSE_DB_POOL"] == expected_pool
+
+
+@pytest.mark.parametrize(
+    "planned_units, budget, blocked",
+    [
+        pytest.param(2, 0, False, id="disabled"),
+        pytest.param(2, 80, False, id="within budget"),
+        pytest.param(3, 80, True, id="over budget"),
+    ],
+)
+def test_db_connection_budget(planned_units: int, budget: int, blocked: bool):
+    """
+    arrange: given a deployed discourse charm with 3 unicorn workers and a sidekiq process
+    act: set the planned units and the database connection budget
+    assert: the unit is blocked if the connections of the units exceed the budget.
+    """
+    harness = helpers.start_harness(with_config={"unicorn_workers": "3"})
+    harness.set_planned_units(planned_units)
+
+    harness.update_config({"db_connection_budget": budget})
+
+    # 3 unicorn workers, a sidekiq process and the ops runner, with a pool of 8 each
+    if blocked:
+        assert harness.model.unit.status == BlockedStatus(
+            "3 units need up to 120 database connections, over the db_connection_budget of 80"
+        )
+    else:
+        assert harness.model.unit.status == ActiveStatus()
+
+
+@pytest.mark.parametrize(
+    "config, expected_env, unset_env",
+    [
+        pytest.param({}, {}, ["LD_PRELOAD", "MALLOC_ARENA_MAX", "MALLOC_CONF"], id="default"),
+        pytest.param(
+            {"malloc_arena_max": 2, "jemalloc_conf": "narenas:2"},
+            {"MALLOC_ARENA_MAX": "2"},
+            ["LD_PRELOAD", "MALLOC_CONF"],
+            id="glibc",
+        ),
+        pytest.param(
+            {"allocator": "jemalloc", "malloc_arena_max": 2, "jemalloc_conf": "narenas:2"},
+            {"LD_PRELOAD": JEMALLOC_LIBRARY, "MALLOC_CONF": "narenas:2"},
+            ["MALLOC_ARENA_MAX"],
+            id="jemalloc",
+        ),
+    ],
+)
+def test_allocator(config: dict, expected_env: dict, unset_env: list):
+    """
+    arrange: given a deployed discourse charm with all the required relations
+    act: set the allocator configuration
+    assert: the allocator settings are set in the environment of the services.
+    """
+    harness = helpers.start_harness()
+
+    harness.update_config(config)
+
+    environment = (
+        harness.get_container_pebble_plan(CONTAINER_NAME).services[SERVICE_NAME].environment
+    )
+    for name, value in expected_env.items():
+        assert environment[name] == value
+    for name in unset_env:
+        assert name not in environment
+
+
+def test_yjit():
+    """
+    arrange: given a charm with a container memory limit of 3 GB
+    act: enable YJIT with an executable memory size of 200 MB
+    assert: YJIT is enabled in the environment, and the unicorn workers are sized with the
+        YJIT memory.
+    """
+    harness = helpers.start_harness()
+    container = harness.charm.unit.get_container(CONTAINER_NAME)
+    container.push("/sys/fs/cgroup/memory.max", str(3 * 1024**3), make_dirs=True)
+
+    harness.update_config({"yjit": True, "yjit_exec_mem_size": 200})
+
+    environment = (
+        harness.get_container_pebble_plan(CONTAINER_NAME).services[SERVICE_NAME].environment
+    )
+    assert environment["RUBY_YJIT_ENABLE"] == "1"
+    assert environment["RUBYOPT"] == "--yjit-exec-mem-size=200"
+    # 3072 MB minus 1000 MB for sidekiq and 600 MB for the master, in 600 MB workers
+    assert environment["UNICORN_WORKERS"] == "2"
+
+
+def test_invalid_allocator():
+    """
+    arrange: given a deployed discourse charm
+    act: set an invalid allocator configuration
+    assert: the unit is blocked.
+    """
+    harness = helpers.start_harness()
+
+    harness.update_config({"allocator": "tcmalloc"})
+
+    assert harness.model.unit.status == BlockedStatus("allocator must be one of: glibc, jemalloc")
+
+
+@pytest.mark.parametrize(
+    "config, expected_env",
+    [
+        pytest.param({}, {}, id="default"),
+        pytest.param(
+            {"ruby_gc_profile": "low-memory"},
+            {"RUBY_GC_HEAP_GROWTH_FACTOR": "1.1", "RUBY_GC_MALLOC_LIMIT": "8000000"},
+            id="profile",
+        ),
+        pytest.param(
+            {
+                "ruby_gc_profile": "throughput",
+                "ruby_gc_overrides": "RUBY_GC_MALLOC_LIMIT=32000000, RUBY_GC_HEAP_FREE_SLOTS=1000",
+            },
+            {
+                "RUBY_GC_HEAP_0_INIT_SLOTS": "600000",
+                "RUBY_GC_MALLOC_LIMIT": "32000000",
+                "RUBY_GC_HEAP_FREE_SLOTS": "1000",
+            },
+            id="overrides",
+        ),
+    ],
+)
+def test_ruby_gc_profile(config: dict, expected_env: dict):
+    """
+    arrange: given a deployed discourse charm with all the required relations
+    act: set the Ruby GC profile and overrides configuration
+    assert: the Ruby GC settings are set in the environment of the services.
+    """
+    harness = helpers.start_harness()
+
+    harness.update_config(config)
+
+    environment = (
+        harness.get_container_pebble_plan(CONTAINER_NAME).services[SERVICE_NAME].environment
+    )
+    assert {name: environment.get(name) for name in expected_env} == expected_env
+    if not expected_env:
+        assert not any(name.startswith("RUBY_GC_") for name in environment)
+
+
+@pytest.mark.parametrize(
+    "config, message",
+    [
+        pytest.param(
+            {"ruby_gc_profile": "fast"},
+            "ruby_gc_profile must be one of: default, throughput, low-memory",
+            id="profile",
+        ),
+        pytest.param(
+            {"ruby_gc_overrides": "LD_PRELOAD=/tmp/lib.so"},
+            "ruby_gc_overrides must be NAME=number pairs of RUBY_GC_ variables",
+            id="variable",
+        ),
+        pytest.param(
+            {"ruby_gc_overrides": "RUBY_GC_HEAP_INIT_SLOTS=600000"},
+            "ruby_gc_overrides must be NAME=number pairs of RUBY_GC_ variables",
+            id="variable without effect",
+        ),
+        pytest.param(
+            {"ruby_gc_overrides": "RUBY_GC_MALLOC_LIMIT=large"},
+            "ruby_gc_overrides must be NAME=number pairs of RUBY_GC_ variables",
+            id="value",
+        ),
+    ],
+)
+def test_invalid_ruby_gc_configuration(config: dict, message: str):
+    """
+    arrange: given a deployed discourse charm
+    act: set an invalid Ruby GC configuration
+    assert: the unit is blocked.
+    """
+    harness = helpers.start_harness()
+
+    harness.update_config(config)
+
+    assert harness.model.unit.status == BlockedStatus(message)
+
+
+@pytest.mark.parametrize(
+    "config, expected_env",
+    [
+        pytest.param(
+            {"performance_profile": "auto"},
+            {"UNICORN_WORKERS": "3", "DISCOURSE_SIDEKIQ_WORKERS": "5", "DISCOURSE_DB_POOL": "8"},
+            id="auto",
+        ),
+        pytest.param(
+            {"performance_profile": "large"},
+            {
+                "UNICORN_WORKERS": "8",
+                "UNICORN_WORKER_MAX_RSS": "1000",
+                "UNICORN_SIDEKIQS": "2",
+                "UNICORN_SIDEKIQ_MAX_RSS": "1500",
+                "DISCOURSE_SIDEKIQ_WORKERS": "15",
+                "DISCOURSE_DB_POOL": "18",
+                "RUBY_GC_HEAP_0_INIT_SLOTS": "600000",
+                "RUBY_YJIT_ENABLE": "1",
+                "RUBYOPT": "--yjit-exec-mem-size=64",
+            },
+            id="large",
+        ),
+        pytest.param(
+            {"performance_profile": "small", "unicorn_workers": "3", "sidekiq_concurrency": 8},
+            {
+                "UNICORN_WORKERS": "3",
+                "UNICORN_SIDEKIQ_MAX_RSS": "500",
+                "DISCOURSE_SIDEKIQ_WORKERS": "8",
+                "DISCOURSE_DB_POOL": "11",
+                "RUBY_GC_MALLOC_LIMIT": "8000000",
+            },
+            id="overrides",
+        ),
+        pytest.param(
+            {"performance_profile": "large", "yjit": False, "ruby_gc_profile": "default"},
+            {
+                "UNICORN_WORKERS": "8",
+                "RUBY_GC_HEAP_GROWTH_FACTOR": None,
+                "RUBY_YJIT_ENABLE": None,
+                "RUBYOPT": None,
+            },
+            id="overrides set to the auto values",
+        ),
+    ],
+)
+def test_performance_profile(config: dict, expected_env: dict):
+    """
+    arrange: given a deployed discourse charm with all the required relations
+    act: set the performance profile, and some of the options it sets
+    assert: the options set take precedence over the profile in the environment.
+    """
+    harness = helpers.start_harness()
+
+    harness.update_config(config)
+
+    environment = (
+        harness.get_container_pebble_plan(CONTAINER_NAME).services[SERVICE_NAME].environment
+    )
+    assert {name: environment.get(name) for name in expected_env} == expected_env
+
+
+@pytest.mark.parametrize(
+    "config, message",
+    [
+        pytest.param(
+            {"performance_profile": "huge"},
+            "performance_profile must be one of: auto, small, medium, large",
+            id="profile",
+        ),
+        pytest.param(
+            {"performance_profile": "medium", "web_worker_max_memory": 300},
+            "web_worker_max_memory must leave room for the expected memory of a web worker "
+            "of 448 MB",
+            id="web worker memory",
+        ),
+        pytest.param(
+            {"performance_profile": "large"},
+            "8 unicorn workers need about 7312 MB, over the container memory limit of 4096 MB",
+            id="memory limit",
+        ),
+    ],
+)
+def test_inconsistent_performance_configuration(config: dict, message: str):
+    """
+    arrange: given a deployed discourse charm with a container memory limit of 4 GB
+    act: set an invalid or inconsistent performance configuration
+    assert: the unit is blocked.
+    """
+    harness = helpers.start_harness()
+    container = harness.charm.unit.get_container(CONTAINER_NAME)
+    container.push("/sys/fs/cgroup/memory.max", str(4 * 1024**3), make_dirs=True)
+
+    harness.update_config(config)
+
+    assert harness.model.unit.status == BlockedStatus(message)
+
+
+@pytest.mark.parametrize(
+    "config, expected_env, migration_endpoint",
+    [
+        pytest.param({}, {}, ("dbhost", "5432"), id="no pooler"),
+        pytest.param(
+            {"db_pooler_mode": "transaction"},
+            {"DISCOURSE_DB_PREPARED_STATEMENTS": "false", "DISCOURSE_DB_ADVISORY_LOCKS": "false"},
+            ("dbhost", "5432"),
+            id="transaction",
+        ),
+        pytest.param(
+            {"db_pooler_mode": "transaction", "db_direct_endpoint": "postgres-0:5433"},
+            {"DISCOURSE_DB_PREPARED_STATEMENTS": "false", "DISCOURSE_DB_ADVISORY_LOCKS": "false"},
+            ("postgres-0", "5433"),
+            id="direct endpoint",
+        ),
+    ],
+)
+def test_db_pooler_mode(config: dict, expected_env: dict, migration_endpoint: tuple):
+    """
+    arrange: given a deployed discourse charm
+    act: set the pooler mode and the direct database endpoint
+    assert: the database settings of the pooler mode are set and the migrations use the
+        direct endpoint, with advisory locks, if configured.
+    """
+    harness = helpers.start_harness(with_config=config)
+    harness.container_pebble_ready(CONTAINER_NAME)
+
+    environment = (
+        harness.get_container_pebble_plan(CONTAINER_NAME).services[SERVICE_NAME].environment
+    )
+    assert environment["DISCOURSE_DB_HOST"] == "dbhost"
+    for key in ("DISCOURSE_DB_PREPARED_STATEMENTS", "DISCOURSE_DB_ADVISORY_LOCKS"):
+        assert environment.get(key) == expected_env.get(key)
+    migration_env = harness.charm._get_migrations_environment()
+    assert (
+        migration_env["DISCOURSE_DB_HOST"],
+        migration_env["DISCOURSE_DB_PORT"],
+    ) == migration_endpoint
+    if config.get("db_direct_endpoint"):
+        assert "DISCOURSE_DB_ADVISORY_LOCKS" not in migration_env
+
+
+@pytest.mark.parametrize(
+    "config, message",
+    [
+        pytest.param(
+            {"db_pooler_mode": "statement"},
+            "db_pooler_mode must be one of: none, session, transaction",
+            id="mode",
+        ),
+        pytest.param(
+            {"db_direct_endpoint": "postgres-0"},
+            "db_direct_endpoint must be host:port",
+            id="endpoint",
+        ),
+    ],
+)
+def test_invalid_db_pooler_configuration(config: dict, message: str):
+    """
+    arrange: given a deployed discourse charm
+    act: set an invalid pooler mode or direct database endpoint
+    assert: the unit is blocked.
+    """
+    harness = helpers.start_harness(with_config=config)
+
+    assert harness.model.unit.status == BlockedStatus(message)
+
+
+def test_workload_version_read_from_image():
+    """
+    arrange: given a deployed discourse charm with the version file built in the image
+    act: trigger the start event
+    assert: the workload version is read from the file without running Rails.
+    """
+    harness = helpers.start_harness(run_initial_hooks=False)
+    runner_calls = []
+    harness.handle_exec(
+        SERVICE_NAME,
+        [f"{DISCOURSE_PATH}/bin/rails", "runner", "puts Discourse::VERSION::STRING"],
+        handler=lambda args: runner_calls.append(args.command),
+    )
+
+    harness.set_leader(False)
+    harness.set_can_connect(CONTAINER_NAME, True)
+    harness.charm.unit.get_container(CONTAINER_NAME).push(
+        WORKLOAD_VERSION_FILE, "2026.1.7\n", make_dirs=True
+    )
+    harness.container_pebble_ready(SERVICE_NAME)
+    harness.charm.on.start.emit()
+    harness.framework.reemit()
+
+    assert harness.get_workload_version() == "2026.1.7"
+    assert not runner_calls
+
+
+@pytest.mark.parametrize(
+    "relation_data, should_be_ready",
+    [
+        (
+            {
+                "database": DATABASE_NAME,
+                "endpoints": "dbhost:5432,dbhost-2:5432",
+                "password": secrets.token_hex(16),
+                "username": "someuser",
+            },
+            True,
+        ),
+        (
+            {
+                "database": DATABASE_NAME,
+                "endpoints": "foo",
                 "password": secrets.token_hex(16),
                 "username": "someuser",
             },
@@ -774,6 +2043,39 @@ def test_is_redis_relation_ready(relation_data, app_data, should_be_ready):
     assert should_be_ready == harness.charm._are_relations_ready()
 
 
+def test_message_bus_redis():
+    """
+    arrange: given a deployed discourse charm with all the required relations
+    act: relate a second redis for the message bus, first without connection details
+    assert: the unit waits for the message bus redis, then Discourse is configured to
+        use it for the message bus only.
+    """
+    harness = helpers.start_harness()
+    harness.container_pebble_ready(CONTAINER_NAME)
+    relation_id = harness.add_relation(
+        "redis-message-bus", "redis-bus", app_data={"leader-host": "redis-bus-0"}
+    )
+    harness.add_relation_unit(relation_id, "redis-bus/0")
+    harness.charm.on.redis_relation_updated.emit()
+
+    assert harness.model.unit.status == WaitingStatus(
+        "Waiting for redis-message-bus relation to initialize"
+    )
+
+    harness.update_relation_data(
+        relation_id, "redis-bus/0", {"hostname": "redis-bus-0", "port": "6380"}
+    )
+
+    environment = (
+        harness.get_container_pebble_plan(CONTAINER_NAME).services[SERVICE_NAME].environment
+    )
+    assert harness.model.unit.status == ActiveStatus()
+    assert environment["DISCOURSE_REDIS_HOST"] == "redis-host"
+    assert environment["DISCOURSE_MESSAGE_BUS_REDIS_ENABLED"] == "true"
+    assert environment["DISCOURSE_MESSAGE_BUS_REDIS_HOST"] == "redis-bus-0"
+    assert environment["DISCOURSE_MESSAGE_BUS_REDIS_PORT"] == "6380"
+
+
 def test_relate_database_at_the_end():
     """
     arrange: given a deployed discourse charm with redis related
@@ -815,6 +2117,55 @@ def test_http_proxy_env(monkeypatch):
     assert created_env["no_proxy"] == "noproxy.test"
 
 
+def test_environment_settings_are_memoized():
+    """
+    arrange: given a deployed discourse charm with all the required relations
+    act: build the environment settings again, then change the config
+    assert: the relation data is only parsed again once the config has changed
+    """
+    harness = helpers.start_harness()
+    get_relation_data = MagicMock(wraps=harness.charm._database.get_relation_data)
+    harness.charm._database.get_relation_data = get_relation_data
+
+    first_env = harness.charm._create_discourse_environment_settings()
+    first_env["DISCOURSE_HOSTNAME"] = "modified"
+    second_env = harness.charm._create_discourse_environment_settings()
+
+    assert get_relation_data.call_count == 0
+    assert second_env["DISCOURSE_HOSTNAME"] == "discourse-k8s"
+
+    harness.disable_hooks()
+    harness.update_config({"external_hostname": "discourse.local"})
+    third_env = harness.charm._create_discourse_environment_settings()
+
+    assert get_relation_data.call_count == 1
+    assert third_env["DISCOURSE_HOSTNAME"] == "discourse.local"
+
+
+def test_relation_data_parsed_once_per_hook():
+    """
+    arrange: given a deployed discourse charm with all the required relations
+    act: update the redis relation data, which sets up and activates the charm
+    assert: the database and redis relation data are only parsed once
+    """
+    harness = helpers.start_harness()
+    harness.container_pebble_ready(CONTAINER_NAME)
+    get_relation_data = MagicMock(wraps=harness.charm._database.get_relation_data)
+    harness.charm._database.get_relation_data = get_relation_data
+    get_redis_relation_data = MagicMock(wraps=harness.charm._get_redis_relation_data)
+    harness.charm._get_redis_relation_data = get_redis_relation_data
+
+    redis_relation = harness.model.get_relation("redis")
+    assert redis_relation
+    harness.update_relation_data(redis_relation.id, "redis/0", {"port": "1011"})
+
+    assert harness.model.unit.status == ActiveStatus()
+    assert get_relation_data.call_count == 1
+    assert get_redis_relation_data.call_count == 1
+    plan = harness.get_container_pebble_plan(CONTAINER_NAME)
+    assert plan.services[SERVICE_NAME].environment["DISCOURSE_REDIS_PORT"] == "1011"
+
+
 def test_acquire_lock_on_upgrade():
     """
     arrange: given a deployed discourse charm with postgresql/redis related